@@ -0,0 +1,543 @@
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import openpyxl
+import pandas as pd
+
+import xslx_to_csv
+
+
+# layout of each of the sheets in the ONS BICS workbook as expected by convert_data_from_xlsx_to_csv()
+# i.e. the header row, in column order. The headers of the metrics match those in sheet_schemas.json, as do the
+# positions of its pcnt_cols and index_col
+sheet_layouts = {
+    'TradingStatus_TS': [
+        'Number', 'Wave', 'Date', 'Industry/ Band',
+        'current and started trading', 'paused trading', 'Has permanently ceased trading ', 'Not sure',
+        'Total trading', 'Weighted count', 'Trading lower ci', 'Trading upper ci', 'Trading se'
+    ],
+    'FinancialPerformance_TS': [
+        'Number', 'Wave', 'Date', 'Industry/ Band',
+        'Turnover has not been affected', 'Lower turnover', 'Higher turnover', 'Not sure',
+        'Turnover decreased by up to 20%', 'Turnover decreased by 20% to 50%', 'Turnover decreased by more than 50%',
+        'Turnover increased', 'Weighted count', 'Turnover lower ci', 'Turnover upper ci', 'Turnover se'
+    ],
+    'WorkforceStatus_TS': [
+        'Wave', 'Date', 'Industry/ Band',
+        'On furlough leave ', 'Working at their normal place of work ',
+        'Working remotely instead of at their normal place of work ', 'Laid off', 'Other', 'Not sure',
+        'Weighted count', 'Unweighted count', 'Workforce se'
+    ],
+    'CashFlow_TS': [
+        'Number', 'Wave', 'Date', 'Industry/ Band',
+        '3 months or less', '4 to 6 months', 'More than 6 months', 'No cash reserves', 'Not sure',
+        'Total', 'Weighted count', 'Cash flow lower ci', 'Cash flow upper ci'
+    ]
+}
+
+def wave_date_str(wave):
+    """
+    build a Date column value for a wave in one of the forms used in the BICS workbook e.g.
+
+    7 to 20 September 2020
+    19 April to 2 May 2021
+    28 December 2020 to 10 January 2021
+
+    :param wave: wave number, waves are fortnightly starting in June 2020
+    :return: str
+    """
+    d_start = datetime.date(2020, 6, 1) + datetime.timedelta(days=14 * wave)
+    d_end = d_start + datetime.timedelta(days=13)
+
+    if d_start.year != d_end.year:
+        return '{0} {1} {2} to {3} {4} {5}'.format(
+            d_start.day, d_start.strftime('%B'), d_start.year, d_end.day, d_end.strftime('%B'), d_end.year
+        )
+    elif d_start.month != d_end.month:
+        return '{0} {1} to {2} {3} {4}'.format(
+            d_start.day, d_start.strftime('%B'), d_end.day, d_end.strftime('%B'), d_end.year
+        )
+    else:
+        return '{0} to {1} {2} {3}'.format(d_start.day, d_end.day, d_end.strftime('%B'), d_end.year)
+
+
+def industry_bands(band_count):
+    """
+    names of the industry_bands written to the synthetic workbook, always including the bands
+    transform_data() explicitly excludes. Some names are padded with whitespace as per the real data
+
+    :param band_count:
+    :return: list of str
+    """
+    bands = [' Education ', 'Health and social work ', '10 to 249 employees', '250+ employees']
+    c = 1
+    while len(bands) < band_count:
+        bands.append('Industry {0} '.format(c))
+        c += 1
+    return bands[:band_count]
+
+
+def generate_workbook(xlsx_fn, waves=30, bands=40, null_fraction=0.05, seed=1, sheets=None):
+    """
+    write a synthetic workbook with the same sheets and layout as the ONS BICS workbook i.e.
+    9 rows of notes, a header row, then one row per wave and industry_band
+
+    the last industry_band in each sheet is always null for every wave so that it gets picked up
+    by rewrite_csvs_w_empty_industry_bands_excluded()
+
+    :param xlsx_fn: path of .xlsx to write
+    :param waves: number of waves
+    :param bands: number of industry_bands per wave
+    :param null_fraction: fraction of metric cells that are written as a * i.e. NULL
+    :param seed: seed for the random number generator so the workbook is reproducible
+    :param sheets: optional list of the sheets to write, default is all of them
+    :return: number of data rows written per sheet
+    """
+    band_names = industry_bands(bands)
+
+    if sheets is None:
+        sheets = list(sheet_layouts)
+
+    wb = openpyxl.Workbook(write_only=True)
+    for sheet in sheets:
+        # seeded per sheet so a workbook with more waves has the same data for the waves in common
+        rnd = random.Random('{0}:{1}'.format(seed, sheet))
+        ws = wb.create_sheet(sheet)
+        header = sheet_layouts[sheet]
+
+        for i in range(9):
+            ws.append(['Note {0}: synthetic data for benchmarking'.format(i + 1)])
+        ws.append(header)
+
+        n = 1
+        for wave in range(1, waves + 1):
+            date_str = wave_date_str(wave)
+            for band_name in band_names:
+                row = []
+                for col in header:
+                    if col == 'Number':
+                        row.append(n)
+                    elif col == 'Wave':
+                        row.append(wave)
+                    elif col == 'Date':
+                        row.append(date_str)
+                    elif col == 'Industry/ Band':
+                        row.append(band_name)
+                    elif col in ('Weighted count', 'Unweighted count'):
+                        row.append(rnd.randint(10, 5000))
+                    elif band_name == band_names[-1] or rnd.random() < null_fraction:
+                        row.append('*')
+                    elif rnd.random() < null_fraction:
+                        row.append(0)
+                    else:
+                        row.append(round(rnd.random(), 6))
+                ws.append(row)
+                n += 1
+
+    wb.save(xlsx_fn)
+
+    return waves * bands
+
+
+def read_sheets_per_sheet(xlsx_fn, read_kwargs_by_sheet):
+    """
+    the read path as it was before iter_sheets_from_xlsx() i.e. the xlsx is opened and parsed once per sheet
+
+    :param xlsx_fn:
+    :param read_kwargs_by_sheet:
+    :return: dict mapping sheet to df
+    """
+    dfs = {}
+    for sheet in read_kwargs_by_sheet:
+        dfs[sheet] = pd.read_excel(xlsx_fn, sheet_name=sheet, **read_kwargs_by_sheet[sheet])
+    return dfs
+
+
+def read_sheets_single_pass(xlsx_fn, read_kwargs_by_sheet):
+    """
+    the read path via iter_sheets_from_xlsx() i.e. the xlsx is opened and parsed once
+
+    :param xlsx_fn:
+    :param read_kwargs_by_sheet:
+    :return: dict mapping sheet to df
+    """
+    dfs = {}
+    for sheet, df in xslx_to_csv.iter_sheets_from_xlsx(xlsx_fn, read_kwargs_by_sheet):
+        dfs[sheet] = df
+    return dfs
+
+
+def best_of(func, repeat, *args):
+    """
+    run func(*args) repeat times, returning the fastest wall clock time in seconds and the result of the last run
+    """
+    timings = []
+    result = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - t0)
+    return min(timings), result
+
+
+def bench_workbook_loading(xlsx_fn, repeat=3):
+    """
+    compare the time taken to read all 4 sheets when the xlsx is parsed once per sheet against
+    reading them via a single pd.ExcelFile
+
+    :param xlsx_fn:
+    :param repeat:
+    :return:
+    """
+    read_kwargs_by_sheet = {}
+    for sheet in sheet_layouts:
+        read_kwargs_by_sheet[sheet] = {
+            'skiprows': 9,
+            'header': 0,
+            'index_col': xslx_to_csv.get_sheet_schema(sheet)['index_col'],
+            'na_values': '*'
+        }
+
+    t_per_sheet, dfs_per_sheet = best_of(read_sheets_per_sheet, repeat, xlsx_fn, read_kwargs_by_sheet)
+    t_single_pass, dfs_single_pass = best_of(read_sheets_single_pass, repeat, xlsx_fn, read_kwargs_by_sheet)
+
+    for sheet in dfs_per_sheet:
+        pd.testing.assert_frame_equal(dfs_per_sheet[sheet], dfs_single_pass[sheet])
+
+    print('Workbook loading, best of {0}:'.format(repeat))
+    print('\t', 'per sheet read_excel:  {0:.3f}s'.format(t_per_sheet))
+    print('\t', 'single pd.ExcelFile:   {0:.3f}s'.format(t_single_pass))
+    print('\t', 'speedup:               {0:.2f}x'.format(t_per_sheet / t_single_pass))
+
+
+def bench_pcnt_formatting(xlsx_fn, sheet='TradingStatus_TS', repeat=3):
+    """
+    compare reading a sheet with the per cell converters against reading it as float64 and formatting the
+    pcnt and industry_band columns a whole column at a time via format_columns_vectorized(). Checks the csv
+    text written from both is the same
+
+    :param xlsx_fn:
+    :param sheet:
+    :param repeat:
+    :return:
+    """
+    sheet_schema = xslx_to_csv.get_sheet_schema(sheet)
+    sheet_reader = xslx_to_csv.compile_sheet_reader(
+        sheet_schema, vectorized=True, header=xslx_to_csv.read_sheet_header(xlsx_fn, sheet_schema)
+    )
+    columns_to_be_formatted = sheet_reader['columns_to_be_formatted']
+
+    read_kwargs = {'skiprows': 9, 'header': 0, 'index_col': sheet_reader['read_kwargs']['index_col'], 'na_values': '*'}
+
+    def read_w_convertors():
+        converters = xslx_to_csv.build_convertors(columns_to_be_formatted)
+        return pd.read_excel(xlsx_fn, sheet_name=sheet, converters=converters, **read_kwargs)
+
+    def read_vectorized():
+        df = pd.read_excel(xlsx_fn, sheet_name=sheet, **read_kwargs)
+        xslx_to_csv.format_columns_vectorized(df, columns_to_be_formatted)
+        return df
+
+    # also time just the formatting, separate from the cost of parsing the xlsx
+    df_raw = pd.read_excel(xlsx_fn, sheet_name=sheet, **read_kwargs)
+
+    def format_only():
+        df = df_raw.copy()
+        xslx_to_csv.format_columns_vectorized(df, columns_to_be_formatted)
+        return df
+
+    t_convertors, df_convertors = best_of(read_w_convertors, repeat)
+    t_vectorized, df_vectorized = best_of(read_vectorized, repeat)
+    t_format_only, df_format_only = best_of(format_only, repeat)
+
+    assert df_convertors.to_csv(index=False) == df_vectorized.to_csv(index=False)
+
+    print('Percentage formatting of {0} rows, best of {1}:'.format(len(df_raw), repeat))
+    print('\t', 'read_excel with converters:       {0:.3f}s'.format(t_convertors))
+    print('\t', 'read_excel then vectorized:       {0:.3f}s'.format(t_vectorized))
+    print('\t', 'vectorized formatting on its own: {0:.3f}s'.format(t_format_only))
+    print('\t', 'csv output identical:             True')
+
+
+def bench_downstream_loads(xlsx_fn, out_path, repeat=5):
+    """
+    compare how long downstream consumers take to load the filtered output as csv against the typed parquet
+    and (memory mapped) feather copies written by transform_data(columnar_formats=...)
+
+    :param xlsx_fn:
+    :param out_path:
+    :param repeat:
+    :return:
+    """
+    import pyarrow.feather as feather
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        xslx_to_csv.transform_data(xlsx_fn, out_path, in_memory=True, columnar_formats=['parquet', 'feather'])
+
+    csv_fn = os.path.join(out_path, 'merged_records_w_all_metrics_filtered.csv')
+
+    t_csv, df_csv = best_of(pd.read_csv, repeat, csv_fn)
+    t_parquet, df_parquet = best_of(pd.read_parquet, repeat, csv_fn.replace('.csv', '.parquet'))
+    # read_table() with memory_map=True only maps the file, the columns aren`t read until they are used, so
+    # the load compared is that of the df from to_pandas(), the time to map it is shown for reference only
+    t_feather_map, table = best_of(
+        functools.partial(feather.read_table, memory_map=True), repeat, csv_fn.replace('.csv', '.feather')
+    )
+    t_feather, df_feather = best_of(
+        lambda fn: feather.read_table(fn, memory_map=True).to_pandas(), repeat, csv_fn.replace('.csv', '.feather')
+    )
+
+    print('Loading {0} rows of merged_records_w_all_metrics_filtered, best of {1}:'.format(len(df_csv), repeat))
+    print('\t', 'pd.read_csv:                             {0:.4f}s'.format(t_csv))
+    print('\t', 'pd.read_parquet:                         {0:.4f}s ({1:.1f}x)'.format(
+        t_parquet, t_csv / t_parquet
+    ))
+    print('\t', 'feather.read_table (mmap) + to_pandas(): {0:.4f}s ({1:.1f}x)'.format(
+        t_feather, t_csv / t_feather
+    ))
+    print('\t', 'feather.read_table (mmap), map only:     {0:.4f}s'.format(t_feather_map))
+
+
+def peak_memory_of(func, *args, **kwargs):
+    """
+    peak memory allocated by python, as traced by tracemalloc, while running func
+
+    :param func:
+    :return: tuple of (peak bytes, the result of func)
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak, result
+
+
+def bench_streaming_memory(tmp_path, wave_counts=(250, 1000), bands=40, sheet='TradingStatus_TS'):
+    """
+    compare the peak memory of converting a sheet to csv by reading it into a df, as convert_data_from_xlsx_to_csv()
+    does by default, against streaming it with convert_sheet_streaming(). The sheet is generated at a number of
+    sizes to show how the peak grows with the number of rows
+
+    :param tmp_path: folder the workbooks and csvs are written to
+    :param wave_counts: the number of waves of each size of sheet
+    :param bands:
+    :param sheet:
+    :return:
+    """
+    print('Peak memory converting {0} to csv, as traced by tracemalloc:'.format(sheet))
+    for waves in wave_counts:
+        src_fn = os.path.join(tmp_path, 'basic data {0} waves.xlsx'.format(waves))
+        row_count = generate_workbook(src_fn, waves=waves, bands=bands, sheets=[sheet])
+
+        peak_df, _ = peak_memory_of(
+            xslx_to_csv.convert_data_from_xlsx_to_csv, src_fn, tmp_path, limit_output_columns=True, sheets=[sheet]
+        )
+        peak_streaming, _ = peak_memory_of(xslx_to_csv.convert_sheet_streaming, src_fn, tmp_path, sheet)
+
+        print('\t', '{0} rows: read_excel {1:.1f}MB, streaming {2:.1f}MB ({3:.1f}x less)'.format(
+            row_count,
+            peak_df / 2 ** 20,
+            peak_streaming / 2 ** 20,
+            peak_df / peak_streaming
+        ))
+
+
+# the stages of the csv path of transform_data() that bench_stages() reports, in the order they run
+stages = ['open_xlsx', 'read_excel', 'wave_start_date', 'to_csv', 'filter_count_pass', 'filter_write_pass', 'write_merged']
+
+
+def time_stages_once(xlsx_fn, out_path):
+    """
+    run transform_data(), with its default i.e. csv path of read --> derive wave_start_date --> write --> filter
+    --> merge, with instrumentation enabled so that each stage is timed by the code that ships rather than a
+    copy of it, see xslx_to_csv.instrument_stage()
+
+    :param xlsx_fn:
+    :param out_path:
+    :return: dict mapping sheet to dict mapping stage to wall clock seconds, stages that aren`t per sheet e.g.
+     open_xlsx are under the sheet None
+    """
+    xslx_to_csv.enable_instrumentation()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            xslx_to_csv.transform_data(xlsx_fn, out_path)
+        records = xslx_to_csv.instrumentation['records']
+    finally:
+        xslx_to_csv.disable_instrumentation()
+
+    timings = {}
+    for record in records:
+        sheet_timings = timings.setdefault(record['sheet'], {})
+        sheet_timings[record['stage']] = sheet_timings.get(record['stage'], 0.0) + record['wall_s']
+
+    return timings
+
+
+def bench_stages(xlsx_fn, out_path, repeat=3):
+    """
+    time each stage of transform_data() per sheet, see time_stages_once(), keeping the fastest of repeat
+    runs of each
+
+    :param xlsx_fn:
+    :param out_path:
+    :param repeat:
+    :return: dict of
+     stages: dict mapping stage to seconds summed over the sheets
+     sheets: dict mapping sheet to dict mapping stage to seconds
+    """
+    best = {}
+    for i in range(repeat):
+        timings = time_stages_once(xlsx_fn, out_path)
+        for sheet in timings:
+            for stage in timings[sheet]:
+                key = (sheet, stage)
+                best[key] = min(best.get(key, timings[sheet][stage]), timings[sheet][stage])
+
+    sheets = {}
+    stage_totals = dict.fromkeys(stages, 0.0)
+    for (sheet, stage), t in best.items():
+        stage_totals[stage] = stage_totals.get(stage, 0.0) + t
+        if sheet is not None:
+            sheets.setdefault(sheet, {})[stage] = t
+
+    return {'stages': stage_totals, 'sheets': sheets}
+
+
+def git_commit():
+    """
+    :return: short hash of the commit checked out alongside this file, None if it can`t be found
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stage_benchmarks(tmp_path, sizes, repeat=3):
+    """
+    bench_stages() over a synthetic workbook of each size, printing a table of the timings per stage
+
+    :param tmp_path: folder the workbooks and csvs are written to
+    :param sizes: list of (waves, bands)
+    :param repeat:
+    :return: results as written out by --json, so runs can be compared across commits
+    """
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'openpyxl': openpyxl.__version__,
+        'repeat': repeat,
+        'sizes': []
+    }
+
+    for waves, bands in sizes:
+        src_fn = os.path.join(tmp_path, 'basic data {0}x{1}.xlsx'.format(waves, bands))
+        row_count = generate_workbook(src_fn, waves=waves, bands=bands)
+
+        size_results = {'waves': waves, 'bands': bands, 'rows_per_sheet': row_count}
+        size_results.update(bench_stages(src_fn, tmp_path, repeat))
+        results['sizes'].append(size_results)
+
+        print('Stages of the csv path for {0} waves x {1} bands ({2} rows per sheet), best of {3}:'.format(
+            waves, bands, row_count, repeat
+        ))
+        for stage in size_results['stages']:
+            print('\t', '{0:<20} {1:.4f}s'.format(stage + ':', size_results['stages'][stage]))
+        print('\t', '{0:<20} {1:.4f}s'.format('total:', sum(size_results['stages'].values())))
+        print('\n')
+
+    return results
+
+
+def parse_size(size):
+    """
+    :param size: str like 30x40 i.e. waves x bands
+    :return: tuple of (waves, bands)
+    """
+    try:
+        waves, bands = size.lower().split('x')
+        return int(waves), int(bands)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected a size like 30x40 i.e. waves x bands, not {0!r}'.format(size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmarks of xslx_to_csv against synthetic BICS workbooks')
+    parser.add_argument(
+        '--size',
+        action='append',
+        type=parse_size,
+        help='waves x bands of the workbook for the stage and loading benchmarks e.g. 30x40, can be given more '
+             'than once, default 30x40'
+    )
+    parser.add_argument('--repeat', type=int, default=3, help='timings are the best of this many runs')
+    parser.add_argument('--json', default=None, help='write the stage timings to this file, - for stdout')
+    parser.add_argument(
+        '--bench',
+        action='append',
+        choices=['stages', 'loading', 'pcnt', 'downstream', 'memory'],
+        help='which benchmarks to run, can be given more than once, default all'
+    )
+    args = parser.parse_args()
+
+    sizes = args.size or [(30, 40)]
+    benches = args.bench or ['stages', 'loading', 'pcnt', 'downstream', 'memory']
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        if 'stages' in benches:
+            results = run_stage_benchmarks(tmp_path, sizes, args.repeat)
+            if args.json == '-':
+                json.dump(results, sys.stdout, indent=2)
+                print('\n')
+            elif args.json is not None:
+                with open(args.json, 'w') as outpf:
+                    json.dump(results, outpf, indent=2)
+
+        if 'loading' in benches:
+            for waves, bands in sizes:
+                src_fn = os.path.join(tmp_path, 'basic data {0}x{1}.xlsx'.format(waves, bands))
+                row_count = generate_workbook(src_fn, waves=waves, bands=bands)
+                print('Synthetic workbook with {0} rows per sheet written to {1}\n'.format(row_count, src_fn))
+
+                bench_workbook_loading(src_fn, args.repeat)
+                print('\n')
+
+        if 'pcnt' in benches:
+            # a single sheet of 100k rows i.e. 2500 waves of 40 industry_bands
+            src_fn = os.path.join(tmp_path, 'basic data 100k.xlsx')
+            generate_workbook(src_fn, waves=2500, bands=40, sheets=['TradingStatus_TS'])
+            bench_pcnt_formatting(src_fn, repeat=1)
+            print('\n')
+
+        if 'downstream' in benches:
+            src_fn = os.path.join(tmp_path, 'basic data 500 waves.xlsx')
+            generate_workbook(src_fn, waves=500, bands=40)
+            try:
+                bench_downstream_loads(src_fn, tmp_path)
+            except ImportError:
+                print('pyarrow is not installed, skipping downstream load benchmark')
+            print('\n')
+
+        if 'memory' in benches:
+            bench_streaming_memory(tmp_path)
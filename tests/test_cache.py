@@ -0,0 +1,126 @@
+import filecmp
+import os
+
+import pytest
+
+import bench_xslx_to_csv
+import xslx_to_csv
+
+
+waves = 4
+bands = 6
+
+
+def output_mtimes(out_path):
+    """
+    :param out_path:
+    :return: dict mapping each file in out_path to its mtime and ctime, the latter as restoring a file from the
+     cache keeps the mtime of the cached copy
+    """
+    mtimes = {}
+    for fn in os.listdir(out_path):
+        st = os.stat(os.path.join(out_path, fn))
+        mtimes[fn] = (st.st_mtime_ns, st.st_ctime_ns)
+    return mtimes
+
+
+def cache_entries(cache_dir):
+    return [key for key in os.listdir(cache_dir) if not key.endswith('.tmp')]
+
+
+@pytest.fixture
+def paths(tmp_path):
+    """
+    a workbook plus out_path and cache_dir, the workbook transformed once so the cache holds every sheet
+    """
+    paths = {
+        'xlsx_fn': str(tmp_path / 'bics.xlsx'),
+        'out_path': str(tmp_path / 'out'),
+        'cache_dir': str(tmp_path / 'cache')
+    }
+    bench_xslx_to_csv.generate_workbook(paths['xlsx_fn'], waves=waves, bands=bands)
+    os.makedirs(paths['out_path'])
+
+    transformed = xslx_to_csv.transform_data(paths['xlsx_fn'], paths['out_path'], cache_dir=paths['cache_dir'])
+    assert transformed == xslx_to_csv.bics_sheets
+
+    return paths
+
+
+def test_cache_hit_writes_nothing(paths):
+    mtimes = output_mtimes(paths['out_path'])
+
+    transformed = xslx_to_csv.transform_data(paths['xlsx_fn'], paths['out_path'], cache_dir=paths['cache_dir'])
+
+    assert transformed == []
+    assert output_mtimes(paths['out_path']) == mtimes
+
+
+def test_cache_hit_restores_outputs(tmp_path, paths):
+    out_path = str(tmp_path / 'restored')
+    os.makedirs(out_path)
+
+    transformed = xslx_to_csv.transform_data(paths['xlsx_fn'], out_path, cache_dir=paths['cache_dir'])
+
+    assert transformed == []
+    assert sorted(os.listdir(out_path)) == sorted(os.listdir(paths['out_path']))
+    for fn in os.listdir(out_path):
+        assert filecmp.cmp(os.path.join(out_path, fn), os.path.join(paths['out_path'], fn), shallow=False), fn
+
+
+def test_cache_miss_on_schema_change(monkeypatch, paths):
+    sheet = 'CashFlow_TS'
+    sheet_schema = [s for s in xslx_to_csv.sheet_schemas['sheets'] if s['sheet'] == sheet][0]
+    # a change to the schema of the sheet which doesn`t change its output
+    monkeypatch.setitem(sheet_schema, 'na_values', xslx_to_csv.sheet_schemas['na_values'] + ['n/a'])
+
+    filtered_fn = xslx_to_csv.csv_fn_for_sheet(paths['out_path'], sheet).replace('.csv', '_filtered.csv')
+    mtimes = output_mtimes(paths['out_path'])
+
+    transformed = xslx_to_csv.transform_data(paths['xlsx_fn'], paths['out_path'], cache_dir=paths['cache_dir'])
+
+    assert transformed == [sheet]
+    changed = [fn for fn, mtime in output_mtimes(paths['out_path']).items() if mtime != mtimes[fn]]
+    assert os.path.basename(filtered_fn) in changed
+    for other_sheet in xslx_to_csv.bics_sheets:
+        if other_sheet != sheet:
+            assert os.path.basename(xslx_to_csv.csv_fn_for_sheet(paths['out_path'], other_sheet)) not in changed
+    assert len(cache_entries(paths['cache_dir'])) == len(xslx_to_csv.bics_sheets) + 1
+
+
+def test_cache_miss_on_workbook_change(tmp_path, paths):
+    xlsx_fn = str(tmp_path / 'bics_new.xlsx')
+    bench_xslx_to_csv.generate_workbook(xlsx_fn, waves=waves + 1, bands=bands)
+
+    transformed = xslx_to_csv.transform_data(xlsx_fn, paths['out_path'], cache_dir=paths['cache_dir'])
+
+    assert transformed == xslx_to_csv.bics_sheets
+
+
+def test_cache_force(paths):
+    transformed = xslx_to_csv.transform_data(
+        paths['xlsx_fn'], paths['out_path'], cache_dir=paths['cache_dir'], force=True
+    )
+
+    assert transformed == xslx_to_csv.bics_sheets
+    assert len(cache_entries(paths['cache_dir'])) == len(xslx_to_csv.bics_sheets)
+
+
+def test_cache_eviction(tmp_path, paths):
+    # the entries of the first sheets are the least recently used
+    for i, key in enumerate(sorted(cache_entries(paths['cache_dir']))):
+        os.utime(os.path.join(paths['cache_dir'], key), (i, i))
+    newest = sorted(cache_entries(paths['cache_dir']))[-2:]
+
+    evicted = xslx_to_csv.evict_from_cache(paths['cache_dir'], max_cache_entries=2)
+
+    assert len(evicted) == len(xslx_to_csv.bics_sheets) - 2
+    assert sorted(cache_entries(paths['cache_dir'])) == newest
+
+    # so those sheets are now transformed again, rather than restored
+    transformed = xslx_to_csv.transform_data(
+        paths['xlsx_fn'], paths['out_path'], cache_dir=paths['cache_dir'], max_cache_entries=2
+    )
+
+    assert len(transformed) == len(xslx_to_csv.bics_sheets) - 2
+    assert len(cache_entries(paths['cache_dir'])) == 2
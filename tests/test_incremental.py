@@ -0,0 +1,97 @@
+import filecmp
+import os
+import shutil
+
+import pytest
+
+import bench_xslx_to_csv
+import xslx_to_csv
+
+
+waves = 6
+bands = 8
+
+
+def sheet_csv_fns(out_path):
+    """
+    :param out_path:
+    :return: list of the raw and filtered csv of each sheet
+    """
+    fns = []
+    for sheet in xslx_to_csv.bics_sheets:
+        out_fn = xslx_to_csv.csv_fn_for_sheet(out_path, sheet)
+        fns += [out_fn, out_fn.replace('.csv', '_filtered.csv')]
+    return fns
+
+
+def assert_same_csvs(out_path, expected_path):
+    for fn, expected_fn in zip(sheet_csv_fns(out_path), sheet_csv_fns(expected_path)):
+        assert filecmp.cmp(fn, expected_fn, shallow=False), '{0} differs from a full rebuild'.format(fn)
+
+
+@pytest.fixture
+def workbooks(tmp_path):
+    """
+    workbooks of waves and waves + 2, the latter also without WorkforceStatus_TS so that sheet fails
+    """
+    xlsx_fns = {
+        'old': str(tmp_path / 'old.xlsx'),
+        'new': str(tmp_path / 'new.xlsx'),
+        'broken': str(tmp_path / 'broken.xlsx')
+    }
+    bench_xslx_to_csv.generate_workbook(xlsx_fns['old'], waves=waves, bands=bands)
+    bench_xslx_to_csv.generate_workbook(xlsx_fns['new'], waves=waves + 2, bands=bands)
+    bench_xslx_to_csv.generate_workbook(
+        xlsx_fns['broken'], waves=waves + 2, bands=bands,
+        sheets=[sheet for sheet in xslx_to_csv.bics_sheets if sheet != 'WorkforceStatus_TS']
+    )
+
+    expected_path = str(tmp_path / 'expected')
+    os.makedirs(expected_path)
+    xslx_to_csv.transform_data(xlsx_fns['new'], expected_path, in_memory=True, write_raw_csvs=True)
+    xlsx_fns['expected_path'] = expected_path
+
+    return xlsx_fns
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_incremental_matches_full_rebuild(tmp_path, workbooks, workers):
+    out_path = str(tmp_path / 'out')
+    os.makedirs(out_path)
+
+    for xlsx_fn in (workbooks['old'], workbooks['new']):
+        xslx_to_csv.transform_data(xlsx_fn, out_path, incremental=True, write_raw_csvs=True, workers=workers)
+
+    assert xslx_to_csv.load_incremental_state(out_path)['sheets']['TradingStatus_TS']['last_wave'] == waves + 2
+    assert_same_csvs(out_path, workbooks['expected_path'])
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_incremental_retry_after_failed_sheet(tmp_path, workbooks, workers):
+    out_path = str(tmp_path / 'out')
+    os.makedirs(out_path)
+
+    xslx_to_csv.transform_data(workbooks['old'], out_path, incremental=True, write_raw_csvs=True, workers=workers)
+    with pytest.raises(Exception):
+        xslx_to_csv.transform_data(
+            workbooks['broken'], out_path, incremental=True, write_raw_csvs=True, workers=workers
+        )
+    xslx_to_csv.transform_data(workbooks['new'], out_path, incremental=True, write_raw_csvs=True, workers=workers)
+
+    assert_same_csvs(out_path, workbooks['expected_path'])
+
+
+def test_incremental_retry_with_stale_state(tmp_path, workbooks):
+    out_path = str(tmp_path / 'out')
+    os.makedirs(out_path)
+    state_fn = os.path.join(out_path, xslx_to_csv.incremental_state_fn)
+
+    xslx_to_csv.transform_data(workbooks['old'], out_path, incremental=True, write_raw_csvs=True)
+    shutil.copy(state_fn, state_fn + '.old')
+
+    # as if the run had appended the new waves but failed before saving the state
+    xslx_to_csv.transform_data(workbooks['new'], out_path, incremental=True, write_raw_csvs=True)
+    shutil.copy(state_fn + '.old', state_fn)
+    xslx_to_csv.transform_data(workbooks['new'], out_path, incremental=True, write_raw_csvs=True)
+
+    assert_same_csvs(out_path, workbooks['expected_path'])
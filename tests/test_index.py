@@ -0,0 +1,132 @@
+import os
+
+import pandas as pd
+import pytest
+
+import bench_xslx_to_csv
+import xslx_to_csv
+
+
+waves = 5
+bands = 10
+
+
+def filtered_csv_fn(out_path, sheet):
+    return xslx_to_csv.csv_fn_for_sheet(out_path, sheet).replace('.csv', '_filtered.csv')
+
+
+def read_filtered_csv(csv_fn):
+    """
+    the whole of one of the *_filtered.csv, read the plain way, to check the indexed reads against
+    """
+    return pd.read_csv(csv_fn, dtype=str, keep_default_na=False).rename(columns=xslx_to_csv.reverse_header_lookup)
+
+
+def assert_matches_read_csv(csv_fn):
+    df = read_filtered_csv(csv_fn)
+    assert df['industry_band'].nunique() > 1
+    metrics = [c for c in xslx_to_csv.metric_columns_of(df.columns) if c in xslx_to_csv.header_lookup]
+
+    for industry_band in df['industry_band'].unique():
+        band_df = df[df['industry_band'] == industry_band].sort_values('wave', key=lambda s: s.astype('int64'))
+        for metric in metrics:
+            expected = pd.Series(
+                band_df[metric].mask(band_df[metric] == '').astype('float64').to_numpy(),
+                index=pd.Index(band_df['wave'].astype('int64'), name='wave'),
+                name=metric
+            )
+            pd.testing.assert_series_equal(xslx_to_csv.get_series(csv_fn, metric, industry_band), expected)
+
+    for wave in df['wave'].unique():
+        expected = df[df['wave'] == wave].sort_values('industry_band').reset_index(drop=True)
+        pd.testing.assert_frame_equal(xslx_to_csv.get_cross_section(csv_fn, int(wave)), expected)
+
+
+@pytest.fixture
+def workbooks(tmp_path):
+    xlsx_fns = {
+        'old': str(tmp_path / 'old.xlsx'),
+        'new': str(tmp_path / 'new.xlsx')
+    }
+    bench_xslx_to_csv.generate_workbook(xlsx_fns['old'], waves=waves, bands=bands, null_fraction=0.2)
+    bench_xslx_to_csv.generate_workbook(xlsx_fns['new'], waves=waves + 2, bands=bands, null_fraction=0.2)
+    return xlsx_fns
+
+
+@pytest.fixture
+def out_path(tmp_path):
+    out_path = str(tmp_path / 'out')
+    os.makedirs(out_path)
+    return out_path
+
+
+def test_indexed_reads_match_read_csv(workbooks, out_path):
+    xslx_to_csv.transform_data(workbooks['old'], out_path, index_outputs=True)
+
+    for sheet in xslx_to_csv.bics_sheets:
+        assert_matches_read_csv(filtered_csv_fn(out_path, sheet))
+
+
+def test_indexed_reads_by_tableau_name(workbooks, out_path):
+    xslx_to_csv.transform_data(workbooks['old'], out_path, index_outputs=True)
+    csv_fn = filtered_csv_fn(out_path, 'TradingStatus_TS')
+
+    pd.testing.assert_series_equal(
+        xslx_to_csv.get_series(csv_fn, 'Paused trading', 'Industry 1'),
+        xslx_to_csv.get_series(csv_fn, 'ts_paused_trading', 'Industry 1')
+    )
+
+
+def test_indexed_reads_of_what_is_not_there(workbooks, out_path):
+    xslx_to_csv.transform_data(workbooks['old'], out_path, index_outputs=True)
+    csv_fn = filtered_csv_fn(out_path, 'TradingStatus_TS')
+
+    assert len(xslx_to_csv.get_series(csv_fn, 'ts_paused_trading', 'no such industry_band')) == 0
+    assert len(xslx_to_csv.get_cross_section(csv_fn, waves + 1)) == 0
+    with pytest.raises(ValueError):
+        xslx_to_csv.get_series(csv_fn, 'cf_lt_3mths', 'Industry 1')
+
+
+def test_stale_index_is_not_used(workbooks, out_path):
+    xslx_to_csv.transform_data(workbooks['old'], out_path, index_outputs=True)
+    csv_fn = filtered_csv_fn(out_path, 'TradingStatus_TS')
+
+    with open(csv_fn, 'a') as outpf:
+        outpf.write('"{0}","x","x","Industry 1","1.0","1.0","1.0"\n'.format(waves + 1))
+
+    with pytest.raises(ValueError):
+        xslx_to_csv.get_series(csv_fn, 'ts_paused_trading', 'Industry 1')
+    with pytest.raises(ValueError):
+        xslx_to_csv.get_cross_section(csv_fn, 1)
+
+
+def test_csv_not_indexed(workbooks, out_path):
+    xslx_to_csv.transform_data(workbooks['old'], out_path)
+
+    with pytest.raises(ValueError):
+        xslx_to_csv.get_cross_section(filtered_csv_fn(out_path, 'TradingStatus_TS'), 1)
+
+
+def test_index_after_incremental_appends(workbooks, out_path):
+    xslx_to_csv.transform_data(workbooks['old'], out_path, incremental=True, index_outputs=True)
+
+    # appending the new waves without re-indexing leaves the index out of date
+    xslx_to_csv.transform_data(workbooks['new'], out_path, incremental=True)
+    csv_fn = filtered_csv_fn(out_path, 'TradingStatus_TS')
+    with pytest.raises(ValueError):
+        xslx_to_csv.get_cross_section(csv_fn, waves + 1)
+
+    for sheet in xslx_to_csv.bics_sheets:
+        xslx_to_csv.index_csv(filtered_csv_fn(out_path, sheet))
+        assert_matches_read_csv(filtered_csv_fn(out_path, sheet))
+    assert len(xslx_to_csv.get_cross_section(csv_fn, waves + 2)) > 0
+
+
+def test_index_outputs_with_incremental(workbooks, out_path):
+    for xlsx_fn in (workbooks['old'], workbooks['new']):
+        xslx_to_csv.transform_data(xlsx_fn, out_path, incremental=True, index_outputs=True)
+
+    for sheet in xslx_to_csv.bics_sheets:
+        assert_matches_read_csv(filtered_csv_fn(out_path, sheet))
+    csv_fn = filtered_csv_fn(out_path, 'TradingStatus_TS')
+    assert list(xslx_to_csv.get_series(csv_fn, 'ts_paused_trading', 'Industry 1').index) == list(range(1, waves + 3))
@@ -0,0 +1,103 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import xslx_to_csv
+
+
+errors = xslx_to_csv.wave_date_range_errors
+
+# value of the Date column --> (start date, end date, wave length) or the reason it is malformed
+wave_date_ranges = {
+    # the documented forms
+    '19 April to 2 May 2021': (datetime.date(2021, 4, 19), datetime.date(2021, 5, 2), 14),
+    '7 to 20 September 2020': (datetime.date(2020, 9, 7), datetime.date(2020, 9, 20), 14),
+    '28 December 2020 to 10 January 2021': (datetime.date(2020, 12, 28), datetime.date(2021, 1, 10), 14),
+    '28 December to 10 January 2021': (datetime.date(2020, 12, 28), datetime.date(2021, 1, 10), 14),
+    # dashes rather than to
+    '19 April – 2 May 2021': (datetime.date(2021, 4, 19), datetime.date(2021, 5, 2), 14),
+    '19 April - 2 May 2021': (datetime.date(2021, 4, 19), datetime.date(2021, 5, 2), 14),
+    '7-20 September 2020': (datetime.date(2020, 9, 7), datetime.date(2020, 9, 20), 14),
+    # abbreviated months
+    '7 to 20 Sept 2020': (datetime.date(2020, 9, 7), datetime.date(2020, 9, 20), 14),
+    '24 Aug. to 6 Sept. 2020': (datetime.date(2020, 8, 24), datetime.date(2020, 9, 6), 14),
+    ' 19 april to 2 MAY 2021 ': (datetime.date(2021, 4, 19), datetime.date(2021, 5, 2), 14),
+    # malformed
+    '19 April to 2 May': errors['no_match'],
+    '19 April 2 May 2021': errors['no_match'],
+    'April 2021': errors['no_match'],
+    '': errors['no_match'],
+    '19 Apirl to 2 May 2021': errors['unknown_month'],
+    '31 April to 13 May 2021': errors['invalid_date'],
+    '29 February to 13 March 2021': errors['invalid_date'],
+    '20 May to 2 May 2021': errors['starts_after_end'],
+    '20 May 2021 to 2 May 2021': errors['starts_after_end'],
+    '20 to 2 May 2021': errors['starts_after_end'],
+    '28 December 2021 to 10 January 2021': errors['starts_after_end'],
+}
+
+
+@pytest.mark.parametrize('value', list(wave_date_ranges))
+def test_parse_wave_date_range(value):
+    expected = wave_date_ranges[value]
+
+    if isinstance(expected, str):
+        with pytest.raises(ValueError) as e:
+            xslx_to_csv.parse_wave_date_range(value)
+        assert e.value.reason == expected
+    else:
+        assert xslx_to_csv.parse_wave_date_range(value) == expected
+
+
+def test_create_start_date_from_data_col():
+    assert xslx_to_csv.create_start_date_from_data_col('28 December to 10 January 2021') == '28-12-2020'
+
+
+def test_check_wave_dates_matches_parse_wave_date_range():
+    values = list(wave_date_ranges)
+    # as in a sheet, where each value is repeated for every industry_band
+    date_col = pd.Series(values + values[::-1], dtype=object, index=range(10, 10 + 2 * len(values)))
+
+    ranges, date_errors = xslx_to_csv.check_wave_dates(date_col)
+
+    assert list(ranges.index) == list(date_col.index)
+    for row, value in enumerate(date_col):
+        expected = wave_date_ranges[value]
+        r = ranges.iloc[row]
+        if isinstance(expected, str):
+            assert r['error'] == expected, value
+            assert pd.isna(r['start_date']) and pd.isna(r['end_date']) and pd.isna(r['wave_length'])
+        else:
+            assert r['error'] is None, value
+            assert (r['start_date'].date(), r['end_date'].date(), r['wave_length']) == expected, value
+
+    assert date_errors == [
+        {'row': row, 'value': value, 'error': wave_date_ranges[value]}
+        for row, value in enumerate(date_col) if isinstance(wave_date_ranges[value], str)
+    ]
+
+
+def test_check_wave_dates_missing_values():
+    date_col = pd.Series([None, '19 April to 2 May 2021', np.nan, '31 April to 13 May 2021', None], dtype=object)
+
+    ranges, date_errors = xslx_to_csv.check_wave_dates(date_col)
+
+    for row in (0, 2, 4):
+        r = ranges.iloc[row]
+        assert pd.isna(r['start_date']) and pd.isna(r['end_date']) and pd.isna(r['wave_length'])
+        assert r['error'] is None
+    assert ranges.iloc[1]['start_date'] == pd.Timestamp(2021, 4, 19)
+    assert date_errors == [{'row': 3, 'value': '31 April to 13 May 2021', 'error': errors['invalid_date']}]
+
+    start_dates = xslx_to_csv.format_wave_start_dates(ranges['start_date'])
+    assert start_dates.iloc[1] == '19-04-2021'
+    assert start_dates[[0, 2, 3, 4]].isna().all()
+
+
+def test_check_wave_dates_all_missing():
+    ranges, date_errors = xslx_to_csv.check_wave_dates(pd.Series([None, None], dtype=object))
+
+    assert ranges['start_date'].isna().all()
+    assert date_errors == []
@@ -1,117 +1,514 @@
+import argparse
+import contextlib
 import csv
+import filecmp
+import functools
+import glob
+import hashlib
+import io
+import json
+import logging
 import os
-import pandas as pd
+import re
+import shutil
+import tempfile
+import time
 import datetime
 
+# numpy and pandas, as well as openpyxl and pyarrow, are imported by the functions that use them rather than
+# here, so that commands which only touch the csvs e.g. filter and validate don`t pay the cost of importing them
 
-# def write_merged_csv(out_path):
-#     """
-#     take the 4 csv`s produced by convert_data and merges into a single csv containing
-#     wave, industry_band and the columns from the 4 csv`s
-#
-#     NOTE: (start) date of waves in FinancialPerformance is inconsistent with other data
-#     according to FG`s notes this is because the question refers to previous week
-#     assumption is that the data can from different metrics can still be grouped by wave
-#     even though in the case of FinancialPerformance this is 1 week difft
-#     """
-#     indv_csvs = {
-#         'cf': os.path.join(out_path, 'cashflow.csv'),
-#         'fp': os.path.join(out_path, 'financialperformance.csv'),
-#         'ts': os.path.join(out_path, 'tradingstatus.csv'),
-#         'ws': os.path.join(out_path, 'workforcestatus.csv')
-#     }
-#
-#     merged_records = {}
-#
-#     for metric in indv_csvs:
-#         pth_to_csv = indv_csvs[metric]
-#         with open(pth_to_csv, 'r') as inpf:
-#             my_reader = csv.DictReader(inpf)
-#
-#             for r in my_reader:
-#                 wave = r['wave']
-#                 industry_band = r['industry_band']
-#                 k = '__'.join([wave, industry_band])
-#                 if metric == 'cf':
-#                     cf_lt_3mths = r['cf_lt_3mths']
-#                     data_for_metric = {
-#                         'cf_lt_3mths':  cf_lt_3mths
-#                     }
-#
-#                 elif metric == 'fp':
-#                     fp_turnover_not_affected = r['fp_turnover_not_affected']
-#                     fp_lower_turnover = r['fp_lower_turnover']
-#                     fp_higher_turnover = r['fp_higher_turnover']
-#                     data_for_metric = {
-#                         'fp_turnover_not_affected': fp_turnover_not_affected,
-#                         'fp_lower_turnover': fp_lower_turnover,
-#                         'fp_higher_turnover': fp_higher_turnover
-#                     }
-#                 elif metric == 'ts':
-#                     ts_ceased_trading = r['ts_ceased_trading']
-#                     ts_current_and_started_trading = r['ts_current_and_started_trading']
-#                     ts_paused_trading = r['ts_paused_trading']
-#                     data_for_metric = {
-#                         'ts_ceased_trading': ts_ceased_trading,
-#                         'ts_current_and_started_trading': ts_current_and_started_trading,
-#                         'ts_paused_trading': ts_paused_trading
-#                     }
-#                 elif metric == 'ws':
-#                     ws_on_furlough = r['ws_on_furlough']
-#                     ws_working_normal_place_of_work = r['ws_working_normal_place_of_work']
-#                     ws_wfh = r['ws_wfh']
-#                     data_for_metric = {
-#                         'ws_on_furlough': ws_on_furlough,
-#                         'ws_working_normal_place_of_work': ws_working_normal_place_of_work,
-#                         'ws_wfh': ws_wfh
-#                     }
-#
-#                 if k in merged_records:
-#                     merged_records[k][metric] = data_for_metric
-#                 else:
-#                     merged_record = {'cf': None, 'fp': None, 'ts': None, 'ws': None}
-#                     merged_record[metric] = data_for_metric
-#                     merged_records[k] = merged_record
-#
-#     out_records = []
-#
-#     for k in merged_records:
-#         [wave, industry_band] = k.split('__')
-#         cf_lt_3mths = merged_records[k]['cf']['cf_lt_3mths']
-#         fp_higher_turnover = merged_records[k]['fp']['fp_higher_turnover']
-#         fp_lower_turnover = merged_records[k]['fp']['fp_lower_turnover']
-#         fp_turnover_not_affected = merged_records[k]['fp']['fp_turnover_not_affected']
-#         ts_ceased_trading = merged_records[k]['ts']['ts_ceased_trading']
-#         ts_current_and_started_trading = merged_records[k]['ts']['ts_current_and_started_trading']
-#         ts_paused_trading = merged_records[k]['ts']['ts_paused_trading']
-#         ws_on_furlough = merged_records[k]['ws']['ws_on_furlough']
-#         ws_wfh = merged_records[k]['ws']['ws_wfh']
-#         ws_working_normal_place_of_work = merged_records[k]['ws']['ws_working_normal_place_of_work']
-#
-#         out_record = [
-#             wave,
-#             industry_band,
-#             ts_current_and_started_trading,
-#             ts_paused_trading,
-#             ts_ceased_trading,
-#             cf_lt_3mths,
-#             fp_lower_turnover,
-#             fp_turnover_not_affected,
-#             fp_higher_turnover,
-#             ws_working_normal_place_of_work,
-#             ws_wfh,
-#             ws_on_furlough
-#         ]
-#
-#         out_records.append(out_record)
-#
-#         with open(os.path.join(out_path, 'merged_records_w_all_metrics.csv'), 'w') as outpf:
-#             my_writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-#             header = ['wave', 'industry_band', 'ts_current_and_started_trading', 'ts_paused_trading', 'ts_ceased_trading',
-#                       'cf_lt_3mths', 'fp_lower_turnover', 'fp_turnover_not_affected', 'fp_higher_turnover',
-#                       'ws_working_normal_place_of_work', 'ws_wfh', 'ws_on_furlough']
-#             my_writer.writerow(header)
-#             my_writer.writerows(out_records)
+# resource isn`t available on Windows, peak RSS is then not recorded by instrument_stage()
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# config file defining the layout of each sheet of the BICS xlsx that is converted, see load_sheet_schemas()
+# can be pointed at a different file with the BICS_SHEET_SCHEMAS environment variable
+sheet_schemas_fn = os.environ.get(
+    'BICS_SHEET_SCHEMAS',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheet_schemas.json')
+)
+
+
+def load_sheet_schemas(schemas_fn):
+    """
+    loads the sheet schema registry. The config file defines, once, for each sheet:
+
+    sheet: name of the sheet in the xlsx
+    index_col: position of the column to use as the pandas index when all columns are output, null where there is
+     no such column
+    pcnt_cols: position of each of the columns that are a percentage, only used when all columns are output. These
+     are resolved against the header of the sheet when it is read, see compile_sheet_reader()
+    metrics: the metric columns that are the focus for viz, in the order they are output, each with
+     name: name of the column in the csv
+     source: header of the column in the xlsx
+     tableau_name: name of the column in the *_filtered.csv, which Tableau reads
+    columns: optional, overrides of the top level columns for the sheet
+
+    the top level skiprows, na_values and columns (headers of the wave, date and industry_band columns in
+    the xlsx and their tableau_name) apply to all sheets, merged_metrics is the order of the metric columns
+    in the csv written by write_merged_csv()
+
+    :param schemas_fn: path to the config file
+    :return: dict
+    :raises ValueError: if something needed is missing from the config
+    """
+    with open(schemas_fn, 'r') as inpf:
+        sheet_schemas = json.load(inpf)
+
+    for k in ('skiprows', 'na_values', 'columns', 'sheets'):
+        if k not in sheet_schemas:
+            raise ValueError('{0} is missing {1!r}'.format(schemas_fn, k))
+
+    for sheet_schema in sheet_schemas['sheets']:
+        for k in ('sheet', 'metrics', 'pcnt_cols'):
+            if k not in sheet_schema:
+                raise ValueError('{0}: sheet {1} is missing {2!r}'.format(schemas_fn, sheet_schema.get('sheet'), k))
+
+        for col in sheet_schema['pcnt_cols'] + [sheet_schema.get('index_col')]:
+            if col is not None and (not isinstance(col, int) or isinstance(col, bool) or col < 0):
+                raise ValueError('{0}: sheet {1} has {2!r} where a column position is expected'.format(
+                    schemas_fn, sheet_schema['sheet'], col
+                ))
+
+        for metric in sheet_schema['metrics']:
+            for k in ('name', 'source', 'tableau_name'):
+                if k not in metric:
+                    raise ValueError('{0}: a metric of sheet {1} is missing {2!r}'.format(
+                        schemas_fn, sheet_schema['sheet'], k
+                    ))
+
+    return sheet_schemas
+
+
+sheet_schemas = load_sheet_schemas(sheet_schemas_fn)
+
+
+def get_sheet_schema(sheet):
+    """
+    schema of a sheet from the registry, with the top level columns, skiprows and na_values filled in
+
+    :param sheet: name of the sheet
+    :return: dict
+    :raises ValueError: if the sheet isn`t in the registry
+    """
+    for sheet_schema in sheet_schemas['sheets']:
+        if sheet_schema['sheet'] == sheet:
+            columns = dict(sheet_schemas['columns'])
+            columns.update(sheet_schema.get('columns', {}))
+
+            full_sheet_schema = {
+                'skiprows': sheet_schemas['skiprows'],
+                'na_values': sheet_schemas['na_values'],
+                'index_col': None
+            }
+            full_sheet_schema.update(sheet_schema)
+            full_sheet_schema['columns'] = columns
+
+            return full_sheet_schema
+
+    raise ValueError('sheet {0} is not in {1}'.format(sheet, sheet_schemas_fn))
+
+
+# the sheets of the BICS xlsx that are converted, in the order they are converted
+bics_sheets = [sheet_schema['sheet'] for sheet_schema in sheet_schemas['sheets']]
+
+
+def build_header_lookup():
+    """
+    :return: dict mapping the name of each column in the csvs to its tableau_name from the registry
+    """
+    lookup = {}
+    for k in ('wave', 'date', 'wave_start_date', 'industry_band'):
+        lookup[k] = sheet_schemas['columns'][k]['tableau_name']
+    for sheet_schema in sheet_schemas['sheets']:
+        for metric in sheet_schema['metrics']:
+            lookup[metric['name']] = metric['tableau_name']
+
+    return lookup
+
+
+def build_merged_header():
+    """
+    :return: list of the columns of the csv written by write_merged_csv(), metrics not listed in merged_metrics
+     go on the end
+    """
+    header = ['wave', 'industry_band'] + sheet_schemas.get('merged_metrics', [])
+    for sheet_schema in sheet_schemas['sheets']:
+        for metric in sheet_schema['metrics']:
+            if metric['name'] not in header:
+                header.append(metric['name'])
+
+    return header
+
+
+# Tableau is able to cope with more readable column names so rename the columns on output via the lookup
+# these are essentially what FG provided in the original xlsx
+header_lookup = build_header_lookup()
+
+# tableau_name --> short name, to map the columns of the *_filtered.csv back
+reverse_header_lookup = {header_lookup[k]: k for k in header_lookup}
+
+merged_header = build_merged_header()
+
+
+# explicit list of industry_band that transform_data() excludes too
+# these may or may not be picked up when checking for nulls. The Health and Education categories Francis has
+# indicated should definately be excluded
+specific_industry_bands_to_exclude = [
+    '10 to 249 employees',
+    '250+ employees',
+    'Health and social work',
+    'Education'
+]
+
+# name of the file in out_root that transform_releases() records the releases converted in
+batch_manifest_fn = 'manifest.json'
+
+# name of the file in out_path that transform_data() keeps its state in when run with incremental=True
+incremental_state_fn = 'transform_data_state.json'
+
+
+# bump this whenever a change to the code changes what is written out, so that entries already in a
+# cache_dir are not used
+cache_version = 2
+
+# default max number of entries kept in a cache_dir, the least recently used are evicted beyond this
+default_max_cache_entries = 32
+
+
+# number of records convert_sheet_streaming() buffers before writing them out to the csv
+default_stream_chunk_size = 10000
+
+
+# month names as they appear in the Date column, lookup is done in lower case
+month_numbers = {
+    'january': 1,
+    'february': 2,
+    'march': 3,
+    'april': 4,
+    'may': 5,
+    'june': 6,
+    'july': 7,
+    'august': 8,
+    'september': 9,
+    'october': 10,
+    'november': 11,
+    'december': 12
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+# state of the per stage instrumentation, see enable_instrumentation() and instrument_stage()
+instrumentation = {
+    'enabled': False,
+    'profile_dir': None,
+    'trace_memory': False,
+    'records': [],
+    # peak traced memory of each of the stages currently running, outermost first
+    'traced_peaks': []
+}
+
+
+def enable_instrumentation(profile_dir=None, trace_memory=False):
+    """
+    start recording wall time, CPU time, memory and row counts for each stage of each sheet, see
+    instrument_stage(). Any records from before are cleared
+
+    :param profile_dir: optional folder to also write a cProfile .prof file of each stage to
+    :param trace_memory: when True tracemalloc is started so that the peak memory allocated during each stage can
+     be recorded too. Tracing slows everything down, so the times recorded with it are inflated
+    :return:
+    """
+    instrumentation['enabled'] = True
+    instrumentation['profile_dir'] = profile_dir
+    instrumentation['trace_memory'] = trace_memory
+    instrumentation['records'] = []
+    instrumentation['traced_peaks'] = []
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+
+def disable_instrumentation():
+    """
+    stop recording, the records so far are kept until the next enable_instrumentation()
+
+    :return:
+    """
+    if instrumentation['trace_memory']:
+        import tracemalloc
+        tracemalloc.stop()
+
+    instrumentation['enabled'] = False
+    instrumentation['profile_dir'] = None
+    instrumentation['trace_memory'] = False
+
+
+def max_rss_bytes():
+    """
+    :return: peak resident set size of this process so far in bytes, None where the resource module isn`t available
+    """
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports in KB, macOS in bytes
+    if os.uname().sysname != 'Darwin':
+        max_rss *= 1024
+
+    return max_rss
+
+
+@contextlib.contextmanager
+def instrument_stage(stage, sheet=None):
+    """
+    records the wall time, CPU time and memory of the stage run inside the with block, logging them and
+    adding them to instrumentation['records']. The with block can set 'rows' in the dict it is given
+
+    e.g.
+    with instrument_stage('read_excel', sheet) as record:
+        df = pd.read_excel(...)
+        record['rows'] = len(df)
+
+    the peak RSS of a process is only ever for its whole lifetime so, rather than that, max_rss_growth_bytes is
+    how much the stage raised it by, 0 where the stage stayed under the peak of an earlier one. When
+    enable_instrumentation() was called with trace_memory, peak_traced_growth_bytes is the peak, as traced by
+    tracemalloc, of the memory allocated during the stage over and above that allocated when it started
+
+    does nothing unless enable_instrumentation() has been called
+
+    :param stage: name of the stage e.g. read_excel
+    :param sheet: name of the sheet, None for stages that aren`t per sheet
+    :return: dict of the record
+    """
+    record = {'stage': stage, 'sheet': sheet, 'rows': None}
+    if not instrumentation['enabled']:
+        yield record
+        return
+
+    profile = None
+    if instrumentation['profile_dir'] is not None:
+        import cProfile
+        profile = cProfile.Profile()
+
+    traced_peaks = instrumentation['traced_peaks']
+    traced_t0 = None
+    if instrumentation['trace_memory']:
+        import tracemalloc
+        traced_t0, traced_peak = tracemalloc.get_traced_memory()
+        # the peak so far belongs to the enclosing stage, if there is one, before it is reset for this stage
+        if len(traced_peaks) > 0:
+            traced_peaks[-1] = max(traced_peaks[-1], traced_peak)
+        traced_peaks.append(0)
+        tracemalloc.reset_peak()
+
+    max_rss_t0 = max_rss_bytes()
+    wall_t0 = time.perf_counter()
+    cpu_t0 = time.process_time()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield record
+    finally:
+        if profile is not None:
+            profile.disable()
+        record['wall_s'] = time.perf_counter() - wall_t0
+        record['cpu_s'] = time.process_time() - cpu_t0
+        record['max_rss_growth_bytes'] = None if max_rss_t0 is None else max_rss_bytes() - max_rss_t0
+        if traced_t0 is not None:
+            import tracemalloc
+            traced_peak = max(traced_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if len(traced_peaks) > 0:
+                traced_peaks[-1] = max(traced_peaks[-1], traced_peak)
+            record['peak_traced_growth_bytes'] = traced_peak - traced_t0
+        instrumentation['records'].append(record)
+
+        if profile is not None:
+            profile.dump_stats(os.path.join(
+                instrumentation['profile_dir'],
+                '{0}.{1}.prof'.format(sheet or 'all', stage)
+            ))
+
+        logger.info('%s %s: wall %.3fs cpu %.3fs max rss growth %s peak traced growth %s rows %s', stage,
+                    sheet or '', record['wall_s'], record['cpu_s'], record['max_rss_growth_bytes'],
+                    record.get('peak_traced_growth_bytes'), record['rows'])
+
+
+def write_metrics_json(out_fn):
+    """
+    dump instrumentation['records'] to a json file
+
+    :param out_fn:
+    :return:
+    """
+    with open(out_fn + '.tmp', 'w') as outpf:
+        json.dump(instrumentation['records'], outpf, indent=2)
+    os.replace(out_fn + '.tmp', out_fn)
+
+
+def write_metrics_prometheus(out_fn):
+    """
+    dump instrumentation['records'] in the Prometheus text format, for the node_exporter textfile collector.
+    Written to a temp file first so that the collector never reads a half written file
+
+    :param out_fn: should end .prom for the collector to pick it up
+    :return:
+    """
+    metrics = [
+        ('wall_s', 'bics_stage_wall_seconds', 'wall clock time of the stage'),
+        ('cpu_s', 'bics_stage_cpu_seconds', 'CPU time of the stage'),
+        ('max_rss_growth_bytes', 'bics_stage_max_rss_growth_bytes', 'increase in the peak RSS during the stage'),
+        ('peak_traced_growth_bytes', 'bics_stage_peak_traced_growth_bytes', 'peak memory allocated by the stage, '
+                                                                             'as traced by tracemalloc'),
+        ('rows', 'bics_stage_rows', 'records processed by the stage')
+    ]
+
+    # a stage can be run more than once for a sheet e.g. open_xlsx by each process of a pool, each series
+    # can only appear once so these are totalled, other than the memory where the max is taken
+    totals = {}
+    for record in instrumentation['records']:
+        labels = (record['stage'], record['sheet'] or '')
+        if labels not in totals:
+            totals[labels] = {}
+        for k, _, _ in metrics:
+            if record.get(k) is None:
+                continue
+            if k not in totals[labels]:
+                totals[labels][k] = record[k]
+            elif k in ('max_rss_growth_bytes', 'peak_traced_growth_bytes'):
+                totals[labels][k] = max(totals[labels][k], record[k])
+            else:
+                totals[labels][k] += record[k]
+
+    lines = []
+    for k, metric_name, metric_help in metrics:
+        lines.append('# HELP {0} {1}'.format(metric_name, metric_help))
+        lines.append('# TYPE {0} gauge'.format(metric_name))
+        for stage, sheet in totals:
+            if k in totals[(stage, sheet)]:
+                lines.append('{0}{{stage="{1}",sheet="{2}"}} {3}'.format(
+                    metric_name,
+                    stage,
+                    sheet,
+                    totals[(stage, sheet)][k]
+                ))
+
+    with open(out_fn + '.tmp', 'w') as outpf:
+        outpf.write('\n'.join(lines) + '\n')
+    os.replace(out_fn + '.tmp', out_fn)
+
+
+# month names as they may be written in the Date column i.e. in full, the first 3 letters, or Sept
+month_lookup = dict(month_numbers)
+month_lookup.update({month[:3]: month_numbers[month] for month in month_numbers})
+month_lookup['sept'] = 9
+
+
+# grammar of the Date column i.e. D [Month [YYYY]] to D Month YYYY, the start leaves off the year or month & year
+# where these are the same as the end. to can also be a - or en/em dash, whitespace and case are not significant
+wave_date_range_re = re.compile(
+    r'^\s*(?P<start_day>\d{1,2})'
+    r'(?:\s+(?P<start_month>[a-z]+)\.?(?:\s+(?P<start_year>\d{4}))?)?'
+    r'\s*(?:to|-|\u2013|\u2014)\s*'
+    r'(?P<end_day>\d{1,2})\s+(?P<end_month>[a-z]+)\.?,?\s+(?P<end_year>\d{4})\s*$',
+    re.IGNORECASE
+)
+
+wave_date_range_format = 'D [Month [YYYY]] to D Month YYYY'
+
+# the reasons a value of the Date column can be malformed, the same whether it is parsed on its own by
+# parse_wave_date_range() or as part of a whole column by check_wave_dates()
+wave_date_range_errors = {
+    'no_match': 'expected ' + wave_date_range_format,
+    'unknown_month': 'unknown month',
+    'invalid_date': 'not a valid date',
+    'starts_after_end': 'starts after it ends'
+}
+
+
+def malformed_wave_date_range(in_date_str, reason):
+    """
+    :param in_date_str: the malformed value of the Date column
+    :param reason: one of wave_date_range_errors
+    :return: ValueError to raise, with reason as its reason attribute
+    """
+    e = ValueError('malformed wave date range {0!r}: {1}'.format(in_date_str, reason))
+    e.reason = reason
+    return e
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_wave_date_range(in_date_str):
+    """
+    parse_wave_date_range('19 April to 2 May 2021')
+    --> (datetime.date(2021, 4, 19), datetime.date(2021, 5, 2), 14)
+
+    parses a value of the Date column with wave_date_range_re, which copes with the different ways things are
+    written in the date column
+
+    e.g.
+    19 April to 2 May 2021 --> 2021-04-19, 2021-05-02
+    7 to 20 September 2020 --> 2020-09-07, 2020-09-20
+    28 December 2020 to 10 January 2021 --> 2020-12-28, 2021-01-10
+    28 December to 10 January 2021 --> 2020-12-28, 2021-01-10
+
+    each wave has a single Date value that is repeated for every industry_band so results are cached.
+    See check_wave_dates() for parsing a whole column
+
+    :param in_date_str: a str like 19 April to 2 May 2021
+    :return: tuple of (start date, end date, wave length in days including both the start and end)
+    :raises ValueError: if in_date_str is not a date range in one of the forms above, with the reason, one of
+     wave_date_range_errors, as its reason attribute
+    """
+    m = wave_date_range_re.match(in_date_str)
+    if m is None:
+        raise malformed_wave_date_range(in_date_str, wave_date_range_errors['no_match'])
+
+    # fill in what is missing from the start from the end
+    start_month = m.group('start_month') or m.group('end_month')
+    for month in (start_month, m.group('end_month')):
+        if month.lower() not in month_lookup:
+            raise malformed_wave_date_range(in_date_str, wave_date_range_errors['unknown_month'])
+
+    try:
+        end_date = datetime.date(
+            int(m.group('end_year')), month_lookup[m.group('end_month').lower()], int(m.group('end_day'))
+        )
+        start_date = datetime.date(
+            int(m.group('start_year') or m.group('end_year')), month_lookup[start_month.lower()],
+            int(m.group('start_day'))
+        )
+        # where the start leaves off the year and the range crosses the new year i.e. it starts in a later month
+        # than it ends, otherwise a start after the end is malformed rather than in the year before
+        if m.group('start_year') is None and start_date.month > end_date.month:
+            start_date = start_date.replace(year=start_date.year - 1)
+    except ValueError:
+        raise malformed_wave_date_range(in_date_str, wave_date_range_errors['invalid_date'])
+
+    if start_date > end_date:
+        raise malformed_wave_date_range(in_date_str, wave_date_range_errors['starts_after_end'])
+
+    return start_date, end_date, (end_date - start_date).days + 1
+
+
+def parse_wave_start_date(in_date_str):
+    """
+    parse_wave_start_date('19 April to 2 May 2021')
+    --> datetime.date(2021, 4, 19)
+
+    :param in_date_str: a str like 19 April to 2 May 2021
+    :return: the start date as a datetime.date
+    :raises ValueError: see parse_wave_date_range()
+    """
+    return parse_wave_date_range(in_date_str)[0]
 
 
 def create_start_date_from_data_col(in_date_str):
@@ -131,53 +528,126 @@ def create_start_date_from_data_col(in_date_str):
     7 to 20 September 2020 --> 07-09-2020
     28 December 2020 to 10 January 2021 --> 28-12-2020
     """
-    [d_start, d_end] = in_date_str.split(' to ')
-    d_parts_s = d_start.split(' ')
-    d_parts_e = d_end.split(' ')
-
-    d_start_d, d_start_m, d_start_y, d_end_d, d_end_m, e_end_y = None, None, None, None, None, None
-
-    if len(d_parts_s) == 1:
-        d_start_d = d_parts_s[0]
-        d_start_m = None
-        d_start_y = None
-    elif len(d_parts_s) == 2:
-        d_start_d = d_parts_s[0]
-        d_start_m = d_parts_s[1]
-        d_start_y = None
-    elif len(d_parts_s) == 3:
-        d_start_d = d_parts_s[0]
-        d_start_m = d_parts_s[1]
-        d_start_y = d_parts_s[2]
-
-    if len(d_parts_e) == 1:
-        d_end_d = d_parts_e[0]
-        d_end_m = None
-        d_end_y = None
-    elif len(d_parts_e) == 2:
-        d_end_d = d_parts_e[0]
-        d_end_m = d_parts_e[1]
-        d_end_y = None
-    elif len(d_parts_e) == 3:
-        d_end_d = d_parts_e[0]
-        d_end_m = d_parts_e[1]
-        d_end_y = d_parts_e[2]
-
-    if d_start_m is None:
-        if d_end_m is not None:
-            d_start_m = d_end_m
-
-    if d_start_y is None:
-        if d_end_y is not None:
-            d_start_y = d_end_y
-
-    start_date = datetime.date(
-        int(d_start_y),
-        datetime.datetime.strptime(d_start_m, "%B").month,
-        int(d_start_d)
+    return datetime.datetime.strftime(parse_wave_start_date(in_date_str), "%d-%m-%Y")
+
+
+def check_wave_dates(date_col):
+    """
+    parse every value of a Date column with wave_date_range_re in one go, via str.extract() over the distinct
+    values, reporting the rows that are malformed rather than raising on the first of them
+
+    :param date_col: pd.Series of str like 19 April to 2 May 2021
+    :return: tuple of (df aligned with date_col of start_date and end_date as datetime64, wave_length in days
+     and error, the reason the value is malformed, None where it isn`t, list of dicts of row (position in
+     date_col), value and error for each malformed row). Missing Date values aren`t malformed, all of
+     their columns are left empty
+    """
+    import numpy as np
+    import pandas as pd
+
+    codes, uniques = pd.factorize(date_col)
+    values = pd.Series(uniques, dtype=object).astype(str)
+
+    parts = values.str.extract(wave_date_range_re)
+    matched = parts['end_year'].notna()
+
+    start_month = parts['start_month'].fillna(parts['end_month']).str.lower().map(month_lookup)
+    end_month = parts['end_month'].str.lower().map(month_lookup)
+    end_year = pd.to_numeric(parts['end_year'])
+
+    end_dates = pd.to_datetime(
+        pd.DataFrame({'year': end_year, 'month': end_month, 'day': pd.to_numeric(parts['end_day'])}),
+        errors='coerce'
+    )
+    start_dates = pd.to_datetime(
+        pd.DataFrame({
+            'year': pd.to_numeric(parts['start_year']).fillna(end_year),
+            'month': start_month,
+            'day': pd.to_numeric(parts['start_day'])
+        }),
+        errors='coerce'
+    )
+
+    # where the start leaves off the year and the range crosses the new year i.e. it starts in a later month
+    # than it ends, as per parse_wave_date_range()
+    crosses_year = parts['start_year'].isna() & (start_month > end_month)
+    start_dates[crosses_year] = start_dates[crosses_year] - pd.DateOffset(years=1)
+
+    unknown_month = matched & (start_month.isna() | end_month.isna())
+    invalid_date = matched & ~unknown_month & (start_dates.isna() | end_dates.isna())
+    starts_after_end = start_dates > end_dates
+    unique_errors = np.select(
+        [~matched, unknown_month, invalid_date, starts_after_end],
+        [wave_date_range_errors[k] for k in ('no_match', 'unknown_month', 'invalid_date', 'starts_after_end')],
+        default=''
+    ).astype(object)
+    is_error = unique_errors != ''
+    unique_errors[~is_error] = None
+
+    # missing values get the code -1 from factorize, which indexes the last element, so each of the arrays
+    # of the distinct values has an empty element on the end for these
+    start_dates = np.append(pd.DatetimeIndex(start_dates).as_unit('ns').to_numpy(), np.datetime64('NaT', 'ns'))
+    end_dates = np.append(pd.DatetimeIndex(end_dates).as_unit('ns').to_numpy(), np.datetime64('NaT', 'ns'))
+    start_dates[np.append(is_error, False)] = np.datetime64('NaT', 'ns')
+    end_dates[np.append(is_error, False)] = np.datetime64('NaT', 'ns')
+    wave_lengths = (end_dates - start_dates) / np.timedelta64(1, 'D') + 1
+    unique_errors = np.append(unique_errors, None)
+
+    ranges = pd.DataFrame({
+        'start_date': start_dates[codes],
+        'end_date': end_dates[codes],
+        'wave_length': pd.array(wave_lengths[codes], dtype='Int64'),
+        'error': pd.Series(unique_errors[codes], index=date_col.index, dtype=object)
+    }, index=date_col.index)
+
+    date_errors = []
+    for row in np.flatnonzero(codes >= 0):
+        if unique_errors[codes[row]] is not None:
+            date_errors.append({
+                'row': int(row),
+                'value': str(uniques[codes[row]]),
+                'error': unique_errors[codes[row]]
+            })
+
+    return ranges, date_errors
+
+
+def format_date_errors(date_errors):
+    """
+    :param date_errors: list from check_wave_dates()
+    :return: str listing each malformed row, one per line, numbered from 1 as the records of the sheet
+    """
+    return '\n\t'.join(
+        'record {0}: malformed wave date range {1!r}: {2}'.format(e['row'] + 1, e['value'], e['error'])
+        for e in date_errors
     )
 
-    return datetime.datetime.strftime(start_date, "%d-%m-%Y")
+
+def report_date_errors(sheet, date_errors):
+    """
+    print the malformed values of the Date column of a sheet, whose wave_start_date has been left empty
+
+    :param sheet: name of the sheet
+    :param date_errors: list from check_wave_dates()
+    """
+    print('{0} malformed value(s) in Date column of {1}, wave_start_date left empty for these:\n\t{2}'.format(
+        len(date_errors),
+        sheet,
+        format_date_errors(date_errors)
+    ))
+
+
+def format_wave_start_dates(start_dates):
+    """
+    :param start_dates: pd.Series of datetime64
+    :return: pd.Series of str in form dd-mm-YYYY, NaN where NaT
+    """
+    import pandas as pd
+
+    return pd.Series(
+        pd.Index(pd.DatetimeIndex(start_dates).strftime('%d-%m-%Y'), dtype=object),
+        index=start_dates.index
+    )
 
 
 def format_cell_pcnt(in_cell_val):
@@ -199,344 +669,2593 @@ def format_industry_band(in_cell_val):
     return out_cell_val
 
 
-def convert_data_from_xlsx_to_csv(xlsx_fn, out_path, limit_output_columns=False):
+def iter_sheets_from_xlsx(xlsx_fn, read_kwargs_by_sheet):
     """
+    reads a number of sheets from an xlsx, yielding a (sheet, df) tuple per sheet
 
-    :param xlsx_fn:  path to .xlsx file
-    :param limit_output_columns: when True only output to csv a subset of the columns, those that are focus for viz,
-     otherwise, default is to output all columns
+    the xlsx is opened once via a single pd.ExcelFile so the zip and the shared strings table
+    are only decompressed and parsed one time rather than once per sheet, as happens when
+    pd.read_excel() is handed the path of the xlsx for each sheet
+
+    :param xlsx_fn: path to .xlsx file
+    :param read_kwargs_by_sheet: dict mapping sheet name to the kwargs (skiprows, index_col, converters etc)
+     to be passed to pd.read_excel() for that sheet, or to a function which is passed the open pd.ExcelFile and
+     returns them, for kwargs that depend on the header of the sheet. Sheets are read in the order of the dict
+    :return: generator of (sheet, df)
+    """
+    import pandas as pd
+
+    with instrument_stage('open_xlsx'):
+        xlsx = pd.ExcelFile(xlsx_fn)
+
+    with xlsx:
+        for sheet in read_kwargs_by_sheet:
+            read_kwargs = read_kwargs_by_sheet[sheet]
+            if callable(read_kwargs):
+                read_kwargs = read_kwargs(xlsx)
+
+            with instrument_stage('read_excel', sheet) as record:
+                df = pd.read_excel(xlsx, sheet_name=sheet, **read_kwargs)
+                record['rows'] = len(df)
+            yield sheet, df
+
+
+def build_convertors(columns_to_be_formatted):
+    """
+    build up a dict mapping column index to conversion function that can be supplied as the
+    converters param in a pandas read_excel call
+
+    :param columns_to_be_formatted: dict mapping column name to 'pcnt' or 'format_industry_band'
+    :return: dict e.g. {'Industry/ Band': format_industry_band, 'paused trading': format_cell_pcnt}
+    """
+    the_convertors = {}
+    for col in columns_to_be_formatted:
+        # i.e. the_convertors['paused trading'] = format_cell_pcnt
+        if columns_to_be_formatted[col] == 'pcnt':
+            the_convertors[col] = format_cell_pcnt
+        elif columns_to_be_formatted[col] == 'format_industry_band':
+            the_convertors[col] = format_industry_band
+
+    return the_convertors
+
+
+def round_pcnt_values(values):
+    """
+    vectorized equivalent of format_cell_pcnt() i.e. multiplies by 100 and rounds to 1 digit to right of the
+    decimal point, but returns float64 rather than str. Written out to csv these give the same text as
+    format_cell_pcnt() e.g. 0.098888 --> 9.9
+
+    np.round() works on the value * 10 which isn`t exact, so for the (few) values which sit close to
+    a .x5 tie the rounding is redone by formatting the value, as format_cell_pcnt() does
+
+    :param values: np.array of float64
+    :return: np.array of float64
+    """
+    import numpy as np
+
+    scaled = values * 100
+    rounded = np.round(scaled, 1)
+
+    with np.errstate(invalid='ignore'):
+        near_tie = np.abs(np.abs(scaled * 10) % 1 - 0.5) < 1e-6
+
+    if near_tie.any():
+        rounded[near_tie] = [float("{:.1f}".format(v)) for v in scaled[near_tie]]
+
+    return rounded
+
+
+def format_columns_vectorized(df, columns_to_be_formatted):
+    """
+    whole column alternative to reading with the converters from build_convertors(). The pcnt columns
+    are read as float64 and formatted via round_pcnt_values(), the industry_band column is stripped.
+    df is modified in place
+
+    :param df: df as read from the xlsx without converters
+    :param columns_to_be_formatted: dict mapping column name to 'pcnt' or 'format_industry_band'
     :return:
     """
+    for col in columns_to_be_formatted:
+        if columns_to_be_formatted[col] == 'pcnt':
+            df[col] = round_pcnt_values(df[col].to_numpy(dtype='float64'))
+        elif columns_to_be_formatted[col] == 'format_industry_band':
+            df[col] = df[col].str.strip()
 
-    all_dates = []
 
-    # which columns we want to apply the format_cell() function to as we read the data in from the xlsx into the df
-    columns_to_reformat_by_sheet = {
-        'TradingStatus_TS': {3: 'format_industry_band', 4: 'pcnt', 5: 'pcnt', 6: 'pcnt', 7: 'pcnt', 8: 'pcnt', 10: 'pcnt', 11: 'pcnt', 12: 'pcnt'},
-        'FinancialPerformance_TS': {3: 'format_industry_band', 4: 'pcnt', 5: 'pcnt', 6: 'pcnt', 7: 'pcnt', 8: 'pcnt', 9: 'pcnt', 10: 'pcnt', 11: 'pcnt', 13: 'pcnt', 14: 'pcnt', 15: 'pcnt'},
-        'WorkforceStatus_TS': {2: 'format_industry_band', 3: 'pcnt', 4: 'pcnt', 5: 'pcnt', 6: 'pcnt', 7: 'pcnt', 8: 'pcnt', 11: 'pcnt'},
-        'CashFlow_TS': {3: 'format_industry_band', 4: 'pcnt', 5: 'pcnt', 6: 'pcnt', 7: 'pcnt', 8: 'pcnt', 9: 'pcnt', 11: 'pcnt', 12: 'pcnt'}
-    }
+def csv_fn_for_sheet(out_path, sheet):
+    """
+    path of the csv a sheet is written out to e.g. TradingStatus_TS --> <out_path>/tradingstatus.csv
 
-    # which columns we want to dump out to the csv
-    # these are the columns that Francis described as being those to focus on
-    # plus a start_date column we will derive
-    # order here is the order we will dump the columns out to in the csv
-    columns_to_output_by_sheet = {
-        'TradingStatus_TS': [
-            'Wave',
-            'Date',
-            'wave_start_date',
-            'Industry/ Band',
-            'Has permanently ceased trading ',
-            'current and started trading',
-            'paused trading'
-        ],
-        'FinancialPerformance_TS': [
-            'Wave',
-            'Date',
-            'wave_start_date',
-            'Industry/ Band',
-            'Turnover has not been affected',
-            'Lower turnover',
-            'Higher turnover'
-        ],
-        'WorkforceStatus_TS': [
-            'Wave',
-            'Date',
-            'wave_start_date',
-            'Industry/ Band',
-            'On furlough leave ',
-            'Working at their normal place of work ',
-            'Working remotely instead of at their normal place of work '
-        ],
-        'CashFlow_TS': [
-            'Wave',
-            'Date',
+    :param out_path:
+    :param sheet:
+    :return:
+    """
+    return os.path.join(out_path, ''.join([sheet.replace('_TS', '').lower(), '.csv']))
+
+
+def sheet_for_csv_fn(csv_fn):
+    """
+    reverse of csv_fn_for_sheet()
+
+    :param csv_fn:
+    :return: name of the sheet, or the file name of csv_fn if it isn`t the csv of one of bics_sheets
+    """
+    for sheet in bics_sheets:
+        if csv_fn_for_sheet(os.path.dirname(csv_fn), sheet) == csv_fn:
+            return sheet
+
+    return os.path.basename(csv_fn)
+
+
+def read_sheet_header(xlsx, sheet_schema):
+    """
+    reads just the header row of a sheet
+
+    :param xlsx: path to .xlsx file or an open pd.ExcelFile
+    :param sheet_schema: from get_sheet_schema()
+    :return: list of the columns of the sheet, named as pandas names them when the sheet is read
+    """
+    import pandas as pd
+
+    return list(pd.read_excel(
+        xlsx, sheet_name=sheet_schema['sheet'], skiprows=sheet_schema['skiprows'], header=0, nrows=0
+    ).columns)
+
+
+def compile_sheet_reader(sheet_schema, limit_output_columns=False, vectorized=False, header=None):
+    """
+    compiles the schema of a sheet into what is needed to read it from the xlsx and get it ready to be written out
+
+    when limit_output_columns only the wave, date, industry_band and metric columns are read from the sheet, via
+    usecols, so the other columns are never turned into a df. The date column is read as str and, when vectorized,
+    the metric columns as float64. Otherwise all columns are read and the pcnt_cols and index_col of the schema,
+    which are positions, are resolved to the columns at those positions in header
+
+    :param sheet_schema: from get_sheet_schema()
+    :param limit_output_columns: see convert_sheets_from_xlsx()
+    :param vectorized: see convert_sheets_from_xlsx()
+    :param header: header of the sheet from read_sheet_header(), needed unless limit_output_columns
+    :return: dict of
+     read_kwargs: kwargs for pd.read_excel()
+     columns_to_be_formatted: as per format_columns_vectorized(), to be applied after the read when vectorized
+     columns_to_output: columns of the df as read to output and their order, None for all columns
+     out_columns: dict mapping the columns of the df as read to the names they are output as
+    """
+    columns = sheet_schema['columns']
+    metric_sources = [metric['source'] for metric in sheet_schema['metrics']]
+
+    # which columns we want to format as we read the data in from the xlsx into the df, by header
+    columns_to_be_formatted = {columns['industry_band']['source']: 'format_industry_band'}
+    dtype = None
+
+    if limit_output_columns:
+        usecols = [columns['wave']['source'], columns['date']['source'], columns['industry_band']['source']]
+        usecols += metric_sources
+        index_col = None
+
+        for metric_source in metric_sources:
+            columns_to_be_formatted[metric_source] = 'pcnt'
+
+        dtype = {columns['date']['source']: str}
+        if vectorized:
+            for metric_source in metric_sources:
+                dtype[metric_source] = 'float64'
+
+        # the columns that Francis described as being those to focus on plus the start_date column we derive
+        columns_to_output = [
+            columns['wave']['source'],
+            columns['date']['source'],
             'wave_start_date',
-            'Industry/ Band',
-            '3 months or less'
-        ]
+            columns['industry_band']['source']
+        ] + metric_sources
+    else:
+        if header is None:
+            raise ValueError('the header of {0} is needed to read all of its columns'.format(sheet_schema['sheet']))
+
+        usecols = None
+        index_col = sheet_schema['index_col']
+
+        positions = list(sheet_schema['pcnt_cols'])
+        if index_col is not None:
+            positions.append(index_col)
+        out_of_range = [col for col in positions if col >= len(header)]
+        if len(out_of_range) > 0:
+            raise ValueError('columns {0} are beyond the {1} columns in the header of {2}'.format(
+                out_of_range, len(header), sheet_schema['sheet']
+            ))
+
+        for col in sheet_schema['pcnt_cols']:
+            columns_to_be_formatted[header[col]] = 'pcnt'
+
+        columns_to_output = None
+
+    # build up a dict mapping column to conversion function that can be supplied as the convertors param in the
+    # pandas read_excel call to run conversion on the cell values
+    # when vectorized the columns are instead formatted after the read
+    the_convertors = {}
+    if not vectorized:
+        the_convertors = build_convertors(columns_to_be_formatted)
+
+    read_kwargs = {
+        'skiprows': sheet_schema['skiprows'],  # skip the rows which contain textual notes
+        'header': 0,  # index of row (0-based) containing the header (after we have skipped!)
+        'index_col': index_col,  # which col to use as the pandas index
+        'usecols': usecols,  # only read these columns
+        'dtype': dtype,
+        'na_values': sheet_schema['na_values'],  # NULL values
+        'converters': the_convertors  # convert specified cols as per our defined above the_convertors dict
     }
 
     # cleanup the headers written to output csvs
-    out_headers = {
-        'TradingStatus_TS': ['wave', 'date', 'wave_start_date', 'industry_band', 'ts_ceased_trading', 'ts_current_and_started_trading', 'ts_paused_trading'],
-        'FinancialPerformance_TS': ['wave', 'date', 'wave_start_date', 'industry_band', 'fp_turnover_not_affected', 'fp_lower_turnover', 'fp_higher_turnover'],
-        'WorkforceStatus_TS': ['wave', 'date', 'wave_start_date', 'industry_band', 'ws_on_furlough', 'ws_working_normal_place_of_work', 'ws_wfh'],
-        'CashFlow_TS': ['wave', 'date', 'wave_start_date', 'industry_band', 'cf_lt_3mths']
+    out_columns = {}
+    for k in ('wave', 'date', 'industry_band'):
+        out_columns[columns[k]['source']] = k
+    for metric in sheet_schema['metrics']:
+        out_columns[metric['source']] = metric['name']
+
+    return {
+        'read_kwargs': read_kwargs,
+        'columns_to_be_formatted': columns_to_be_formatted,
+        'columns_to_output': columns_to_output,
+        'out_columns': out_columns
     }
 
-    if os.path.exists(xlsx_fn):
-        for sheet in columns_to_reformat_by_sheet:
-
-            # build up a dict mapping column index to conversion function
-            # that can be supplied as the convertors param in the pandas
-            # read_excel call to run conversion on the cell values
-            the_convertors = {}
-            columns_to_be_formatted = columns_to_reformat_by_sheet[sheet]
-            for col in columns_to_be_formatted:
-                # i.e. the_convertors[4] = format_cell_pcnt
-                if columns_to_be_formatted[col] == 'pcnt':
-                    the_convertors[col] = format_cell_pcnt
-                elif columns_to_be_formatted[col] == 'format_industry_band':
-                    the_convertors[col] = format_industry_band
-
-            # use the first number column as the pandas index
-            pd_index_col = 0
-            if sheet == 'WorkforceStatus_TS':
-                # except in this case where there is no such column
-                pd_index_col = None
-
-            # read the worksheet into a pandas dataframe
-            df = pd.read_excel(
-                xlsx_fn,
-                sheet_name=sheet,
-                skiprows=9,  # skip the first 9 rows as these contain textual notes
-                header=0,  # index of row (0-based) containing the header (after we have skipped!)
-                index_col=pd_index_col,  # which col to use as the pandas index
-                na_values='*',  # NULL values
-                converters=the_convertors  # convert specified cols as per our defined above the_convertors dict
-            )
 
-            # add to the df a new column of start_date of wave using the create_start_date_from_data_col() func
-            # applied to the Date column
-            df['wave_start_date'] = df['Date'].apply(create_start_date_from_data_col)
+def convert_sheets_from_xlsx(xlsx_fn, limit_output_columns=False, vectorized=False, sheets=None):
+    """
+    reads each of the sheets from the xlsx yielding a (sheet, df) tuple per sheet where df is ready to be
+    written out i.e. has the wave_start_date column added and the columns selected, ordered and renamed
+    as per the schema of the sheet, see compile_sheet_reader()
 
-            if limit_output_columns:
-                columns_to_output = columns_to_output_by_sheet[sheet]
-            else:
-                columns_to_output = None
+    :param xlsx_fn:  path to .xlsx file
+    :param limit_output_columns: when True only output a subset of the columns, those that are focus for viz,
+     otherwise, default is to output all columns
+    :param vectorized: when True the pcnt and industry_band columns are formatted a whole column at a time after
+     reading the xlsx rather than cell by cell by converters as it is read. The pcnt columns are then float64
+     rather than str, written to csv they are the same either way
+    :param sheets: optional list of the sheets to read, default is all of bics_sheets
+    :return: generator of (sheet, df)
+    """
+    if sheets is None:
+        sheets = bics_sheets
+
+    sheet_readers = {}
+
+    def compile_read_kwargs(sheet, xlsx):
+        sheet_schema = get_sheet_schema(sheet)
+        # the columns of pcnt_cols and index_col are found by their position in the header of the sheet
+        header = None
+        if not limit_output_columns:
+            header = read_sheet_header(xlsx, sheet_schema)
+
+        sheet_readers[sheet] = compile_sheet_reader(sheet_schema, limit_output_columns, vectorized, header)
+        return sheet_readers[sheet]['read_kwargs']
+
+    read_kwargs_by_sheet = {}
+    for sheet in sheets:
+        read_kwargs_by_sheet[sheet] = functools.partial(compile_read_kwargs, sheet)
+
+    # read each worksheet into a pandas dataframe, the xlsx is only opened and parsed once
+    for sheet, df in iter_sheets_from_xlsx(xlsx_fn, read_kwargs_by_sheet):
+        sheet_reader = sheet_readers[sheet]
+
+        # pandas ignores converters for columns that aren`t there, so a column missing from a new release of the
+        # xlsx would otherwise go unnoticed
+        missing = [col for col in sheet_reader['columns_to_be_formatted'] if col not in df.columns]
+        if len(missing) > 0:
+            raise ValueError('columns {0} are missing from the header of {1}'.format(missing, sheet))
+
+        if vectorized:
+            with instrument_stage('format_columns', sheet) as record:
+                format_columns_vectorized(df, sheet_reader['columns_to_be_formatted'])
+                record['rows'] = len(df)
+
+        # add to the df a new column of start_date of wave derived from the Date column. Malformed Date values
+        # are reported, and their wave_start_date left empty, rather than failing the whole conversion
+        sheet_schema = get_sheet_schema(sheet)
+        date_source = sheet_schema['columns']['date']['source']
+        with instrument_stage('wave_start_date', sheet) as record:
+            ranges, date_errors = check_wave_dates(df[date_source])
+            df['wave_start_date'] = format_wave_start_dates(ranges['start_date'])
+            record['rows'] = len(df)
+            record['date_errors'] = len(date_errors)
+
+        if len(date_errors) > 0:
+            report_date_errors(sheet, date_errors)
+
+        # reindex is used so that we can change the order of the columns
+        # columns indicates which columns are to output and their order
+        out_df = df.reindex(columns=sheet_reader['columns_to_output'])
+        out_df = out_df.rename(columns=sheet_reader['out_columns'])
+
+        yield sheet, out_df
+
+
+def convert_sheet_streaming(xlsx_fn, out_path, sheet, chunk_size=default_stream_chunk_size):
+    """
+    bounded memory alternative to convert_data_from_xlsx_to_csv() with limit_output_columns=True for a single
+    sheet. Rather than the whole sheet being read into a df, the xlsx is opened read only with openpyxl and
+    the rows streamed through with iter_rows(), being formatted as they go and written out to the csv
+    chunk_size records at a time. The csv written is the same as that from convert_data_from_xlsx_to_csv()
+
+    the csv is written to a temp file first which only replaces the csv once the whole sheet is converted
+
+    :param xlsx_fn: path to .xlsx file
+    :param out_path: folder the csv is written to
+    :param sheet: name of the sheet
+    :param chunk_size: number of records buffered between writes
+    :return: number of records written
+    :raises ValueError: if any of the columns in the schema of the sheet are missing from its header
+    """
+    import openpyxl
+
+    sheet_schema = get_sheet_schema(sheet)
+    columns = sheet_schema['columns']
+    na_values = set(sheet_schema['na_values'])
+    na_values.add('')
+
+    out_fn = csv_fn_for_sheet(out_path, sheet)
+    record_count = 0
+    date_errors = []
+
+    wb = openpyxl.load_workbook(xlsx_fn, read_only=True, data_only=True)
+    try:
+        # skip the rows which contain textual notes, the next row is the header
+        rows = wb[sheet].iter_rows(min_row=sheet_schema['skiprows'] + 1, values_only=True)
+        header = list(next(rows, ()))
+
+        sources = [columns[k]['source'] for k in ('wave', 'date', 'industry_band')]
+        sources += [metric['source'] for metric in sheet_schema['metrics']]
+        missing = [source for source in sources if source not in header]
+        if len(missing) > 0:
+            raise ValueError('columns {0} are missing from the header of {1}'.format(missing, sheet))
+
+        wave_idx, date_idx, band_idx = [header.index(source) for source in sources[:3]]
+        metric_idxs = [header.index(source) for source in sources[3:]]
+
+        with open(out_fn + '.tmp', 'w', newline='') as outpf:
+            # same line ending and quoting as df.to_csv() so the csv is the same as from the df
+            my_writer = csv.writer(outpf, lineterminator=os.linesep)
+            my_writer.writerow(
+                ['wave', 'date', 'wave_start_date', 'industry_band'] +
+                [metric['name'] for metric in sheet_schema['metrics']]
+            )
 
-            # write the dataframe out as a CSV file
-            # use columns to select a subset of the columns to write out
-            out_fn = os.path.join(out_path, ''.join([sheet.replace('_TS', '').lower(), '.csv']))
+            chunk = []
+            for r in rows:
+                # pandas drops blank rows, e.g. those left on the end of the sheet
+                if all(v is None or v == '' for v in r):
+                    continue
 
-            out_header = True
-            if sheet in out_headers:
-                out_header = out_headers[sheet]
+                wave = r[wave_idx]
+                if isinstance(wave, float) and wave.is_integer():
+                    wave = int(wave)
 
-            with open(out_fn, 'w', newline='') as outpf:
-                # reindex is used so that we can change the order by which columns are written out as
-                # columns indicates which columns are to output and their order
-                # index=False means don`t include the df index column in the output
-                df.reindex(columns=columns_to_output).to_csv(outpf, columns=columns_to_output, index=False, header=out_header)
+                date_str = r[date_idx]
+                wave_start_date = ''
+                if date_str is None:
+                    date_str = ''
+                else:
+                    date_str = str(date_str)
+                    try:
+                        wave_start_date = create_start_date_from_data_col(date_str)
+                    except ValueError as e:
+                        date_errors.append({'row': record_count + len(chunk), 'value': date_str, 'error': e.reason})
+
+                industry_band = r[band_idx]
+                industry_band = '' if industry_band is None else format_industry_band(str(industry_band))
+
+                out_r = ['' if wave is None else wave, date_str, wave_start_date, industry_band]
+                for i in metric_idxs:
+                    v = r[i]
+                    if v is None or v in na_values:
+                        out_r.append('')
+                    else:
+                        out_r.append(format_cell_pcnt(float(v)))
+
+                chunk.append(out_r)
+                if len(chunk) >= chunk_size:
+                    my_writer.writerows(chunk)
+                    record_count += len(chunk)
+                    chunk = []
+
+            my_writer.writerows(chunk)
+            record_count += len(chunk)
+    except Exception:
+        if os.path.exists(out_fn + '.tmp'):
+            os.remove(out_fn + '.tmp')
+        raise
+    finally:
+        wb.close()
+
+    if len(date_errors) > 0:
+        report_date_errors(sheet, date_errors)
+
+    os.replace(out_fn + '.tmp', out_fn)
+
+    return record_count
+
+
+def convert_data_from_xlsx_to_csv(xlsx_fn, out_path, limit_output_columns=False, vectorized=False, sheets=None,
+                                  workers=None, streaming=False):
+    """
+    dumps out to csv each of the sheets from the xlsx, see convert_sheets_from_xlsx()
 
+    :param xlsx_fn:  path to .xlsx file
+    :param out_path: folder the csvs are written to
+    :param limit_output_columns: when True only output to csv a subset of the columns, those that are focus for viz,
+     otherwise, default is to output all columns
+    :param vectorized: when True the pcnt and industry_band columns are formatted a whole column at a time after
+     reading the xlsx rather than cell by cell by converters as it is read. Output csvs are the same either way
+    :param sheets: optional list of the sheets to convert, default is all of bics_sheets
+    :param workers: when > 1 the sheets are converted concurrently in a pool of this many processes
+    :param streaming: when True each sheet is converted by convert_sheet_streaming() so memory use stays flat
+     however big the sheet. Only for limit_output_columns=True, vectorized is ignored
+    :return:
+    """
+    if streaming and not limit_output_columns:
+        raise ValueError('streaming is only supported with limit_output_columns=True')
 
-def rewrite_csvs_w_empty_industry_bands_excluded(input_csv_fn, metric_count, specific_industry_bands_to_exclude=None):
+    if os.path.exists(xlsx_fn):
+        if sheets is None:
+            sheets = bics_sheets
+
+        if workers is not None and workers > 1:
+            kwargs_by_sheet = {}
+            for sheet in sheets:
+                kwargs_by_sheet[sheet] = {
+                    'xlsx_fn': xlsx_fn,
+                    'out_path': out_path,
+                    'limit_output_columns': limit_output_columns,
+                    'vectorized': vectorized,
+                    'sheets': [sheet],
+                    'streaming': streaming
+                }
+            run_per_sheet_in_pool(convert_data_from_xlsx_to_csv, kwargs_by_sheet, workers)
+            return
+
+        if streaming:
+            for sheet in sheets:
+                with instrument_stage('stream_to_csv', sheet) as record:
+                    record['rows'] = convert_sheet_streaming(xlsx_fn, out_path, sheet)
+            return
+
+        for sheet, out_df in convert_sheets_from_xlsx(xlsx_fn, limit_output_columns, vectorized, sheets):
+            write_sheet_csv(out_df, out_path, sheet)
+
+
+def write_sheet_csv(out_df, out_path, sheet):
     """
-    takes csv generated by convert_data() and re-writes it filtering off records associated with an
-    industry_band where all records per wave of that industry_band present in the csv have null/empty
-    values. Note values of 0 are allowed and don`t count as null/empty
+    writes out the df of a sheet from convert_sheets_from_xlsx() as its csv
 
-    :param input_csv_fn:
-    :param metric_count:
+    :param out_df:
+    :param out_path: folder the csv is written to
+    :param sheet: name of the sheet
     :return:
     """
-    waves_per_band = {}
+    # write the dataframe out as a CSV file
+    with instrument_stage('to_csv', sheet) as record, \
+            open(csv_fn_for_sheet(out_path, sheet), 'w', newline='') as outpf:
+        # index=False means don`t include the df index column in the output
+        out_df.to_csv(outpf, index=False)
+        record['rows'] = len(out_df)
 
-    # Tableau is able to cope with more readable column names so rename the columns on output via the lookup
-    # these are essentially what FG provided in the original xlsx
-    header_lookup = {
-        'wave': 'Wave',
-        'date': 'Date',
-        'wave_start_date': 'Wave start date',
-        'industry_band': 'Industry / Band',
-        'ws_on_furlough': 'On furlough leave',
-        'ws_working_normal_place_of_work': 'Working at their normal place of work',
-        'ws_wfh': 'Working remotely instead of at their normal place of work',
-        'ts_ceased_trading': 'Has permanently ceased trading',
-        'ts_current_and_started_trading': 'Current and started trading',
-        'ts_paused_trading': 'Paused trading',
-        'fp_turnover_not_affected': 'Turnover has not been affected',
-        'fp_lower_turnover': 'Lower Turnover',
-        'fp_higher_turnover': 'Higher Turnover',
-        'cf_lt_3mths': '3 months or less Cashflow'
-    }
 
-    if os.path.exists(input_csv_fn):
-        with open(input_csv_fn, 'r') as inpf:
-            my_reader = csv.DictReader(inpf)
-
-            for r in my_reader:
-                record_is_empty = False
-                null_or_zero_cell_count = 0
-                wave = r['wave']
-                industry_band = r['industry_band']
-                for k in r:
-                    if k not in ('wave', 'date', 'wave_start_date', 'industry_band'):
-                        if r[k] in ('', '0.0'):
-                            null_or_zero_cell_count += 1
-
-                if null_or_zero_cell_count == metric_count:
-                    record_is_empty = True
-
-                if industry_band in waves_per_band:
-                    waves_per_band[industry_band]['count_waves_present_in'] += 1
-                    if record_is_empty:
-                        waves_per_band[industry_band]['count_waves_null_present_in'] += 1
-                else:
-                    waves_per_band[industry_band] = {
-                        'count_waves_present_in': 1,
-                        'count_waves_null_present_in': 0
-                    }
-                    if record_is_empty:
-                        waves_per_band[industry_band]['count_waves_null_present_in'] += 1
-
-        industry_bands_to_exclude = []
-
-        for industry_band in waves_per_band:
-            count_waves_null_present_in = waves_per_band[industry_band]['count_waves_null_present_in']
-            count_waves_present_in = waves_per_band[industry_band]['count_waves_present_in']
-
-            exclude = False
-
-            if count_waves_null_present_in == count_waves_present_in:
-                exclude = True
-                if industry_band not in industry_bands_to_exclude:
-                    industry_bands_to_exclude.append(industry_band)
-
-        if specific_industry_bands_to_exclude is not None:
-            for spc_band in specific_industry_bands_to_exclude:
-                if spc_band not in industry_bands_to_exclude:
-                    industry_bands_to_exclude.append(spc_band)
-
-        if len(industry_bands_to_exclude) > 0:
-            print('The following industry_bands will be excluded:')
-            for industry_band_to_exlude in industry_bands_to_exclude:
-                print('\t', industry_band_to_exlude)
-
-            print('Re-writing {0} as {1} with these excluded'.format(
-                input_csv_fn,
-                input_csv_fn.replace('.csv', '_filtered.csv')
-            ))
-            header = None
-            c = 1
-            with open(input_csv_fn, 'r') as inpf:
-                my_reader = csv.reader(inpf)
-                with open(input_csv_fn.replace('.csv', '_filtered.csv'), 'w', newline='') as outpf:
-                    my_writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
-                    for r in my_reader:
-                        if c == 1:
-                            # change the column names in the header using our lut
-                            header = r
-                            new_header = []
-                            for h in header:
-                                if h in header_lookup:
-                                    new_header.append(header_lookup[h])
-                            my_writer.writerow(new_header)
-                        else:
-                            industry_band = r[3]
-                            write_row = True
-                            if industry_band in industry_bands_to_exclude:
-                                write_row = False
-
-                            if write_row:
-                                my_writer.writerow(r)
-                        c += 1
-        print('\n')
+def call_capturing_output(func, kwargs, profile_dir=None, instrumented=False, trace_memory=False):
+    """
+    calls func(**kwargs) capturing anything it prints, so that output from a pool of processes
+    can be printed in a deterministic order
+
+    :param func:
+    :param kwargs:
+    :param profile_dir: see enable_instrumentation()
+    :param instrumented: when True the stages of func are instrumented, see instrument_stage(), as the
+     records in the process func runs in aren`t otherwise seen by the parent
+    :param trace_memory: see enable_instrumentation()
+    :return: tuple of (printed output, return value of func, list of instrumentation records)
+    """
+    if instrumented:
+        enable_instrumentation(profile_dir, trace_memory)
 
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        result = func(**kwargs)
+    return out.getvalue(), result, instrumentation['records'] if instrumented else []
 
-def validate_filtered_metrics(out_path):
+
+def run_per_sheet_in_pool(func, kwargs_by_sheet, workers, on_result=None):
     """
-    for each of the 10 metrics obtain count of the number of records
-    where the metric value is null or equal to zero
-
-    ts_current_and_started_trading 0
-    ts_paused_trading 87
-    ts_ceased_trading 200
-    cf_lt_3mths 0
-    fp_lower_turnover 15
-    fp_turnover_not_affected 18
-    fp_higher_turnover 26
-    ws_working_normal_place_of_work 0
-    ws_wfh 0
-    ws_on_furlough 0
+    runs func(**kwargs) for each sheet in a concurrent.futures process pool. Once all have finished the
+    output of each is printed and results returned in the order of kwargs_by_sheet, regardless of the
+    order in which they completed
+
+    :param func: a module level function, so it can be pickled
+    :param kwargs_by_sheet: dict mapping sheet to the kwargs func is to be called with for that sheet
+    :param workers: max number of processes
+    :param on_result: optional function called with (sheet, return value of func) for each sheet that
+     succeeded, before any error is raised, so what did succeed can be recorded
+    :return: dict mapping sheet to return value of func
+    :raises RuntimeError: if func failed for any of the sheets, listing the error for each of these
+    """
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for sheet in kwargs_by_sheet:
+            futures[sheet] = executor.submit(
+                call_capturing_output,
+                func,
+                kwargs_by_sheet[sheet],
+                instrumentation['profile_dir'],
+                instrumentation['enabled'],
+                instrumentation['trace_memory']
+            )
+        concurrent.futures.wait(futures.values())
 
-    i.e. for ws_wfh metric all records have a value other than 0
-    whereas for ts_paused_trading 87 records have a value which is 0 or null
+    results = {}
+    errors = []
+    for sheet in futures:
+        try:
+            output, results[sheet], records = futures[sheet].result()
+            print(output, end='')
+            instrumentation['records'].extend(records)
+        except Exception as e:
+            errors.append('{0}: {1!r}'.format(sheet, e))
+            continue
 
-    :param out_path:
-    :return:
-    """
-    metric_values_count_null_or_zero = {
-        'ts_current_and_started_trading': 0,
-        'ts_paused_trading': 0,
-        'ts_ceased_trading': 0,
-        'cf_lt_3mths': 0,
-        'fp_lower_turnover': 0,
-        'fp_turnover_not_affected': 0,
-        'fp_higher_turnover': 0,
-        'ws_working_normal_place_of_work': 0,
-        'ws_wfh': 0,
-        'ws_on_furlough': 0
-    }
+        if on_result is not None:
+            on_result(sheet, results[sheet])
 
-    with open(os.path.join(out_path, 'merged_records_w_all_metrics_filtered.csv'), 'r') as inpf:
-        my_reader = csv.DictReader(inpf)
-        metrics = metric_values_count_null_or_zero.keys()
-        for r in my_reader:
-            for metric in metrics:
-                metric_val = r[metric]
+    if len(errors) > 0:
+        raise RuntimeError('{0} of {1} sheets failed:\n\t{2}'.format(
+            len(errors),
+            len(futures),
+            '\n\t'.join(errors)
+        ))
 
-                # TODO actually we only care about NULL values
-                if metric_val in ('', '0.0'):
-                    metric_values_count_null_or_zero[metric] += 1
+    return results
 
-    print('Results of validating metrics.')
-    print('Counts of records per metric where metric value is null or equal to zero.')
-    print('0 = for the metric means all records have a value')
-    print('value > 0 for the metric means some records don`t have a value or value is equal to zero')
-    for metric in metric_values_count_null_or_zero:
-        print('\t', metric, metric_values_count_null_or_zero[metric])
-
-
-def transform_data(src_fn, out_path):
-    # [1] first we dump out to csv each of the 4 sheets from the xlsx
-    convert_data_from_xlsx_to_csv(
-        xlsx_fn=src_fn,
-        out_path=out_path,
-        limit_output_columns=True
-    )
 
-    # [2] then we re-write the csvs filtering off industry_band where there are waves containing completely null records
-    # in addition now we can also pass in a list of industry_band that should be explicitly excluded too
-    # these may or may not be picked up when checking for nulls. The Health and Education categories Francis has
-    # indicated should definately be excluded
-    specific_industry_bands_to_exclude = [
-        '10 to 249 employees',
-        '250+ employees',
-        'Health and social work',
-        'Education'
-    ]
+def metric_columns_of(columns):
+    """
+    :param columns: columns of a csv or df written by the conversion
+    :return: list of the columns that are metrics i.e. all but wave, date, wave_start_date and industry_band
+    """
+    return [c for c in columns if c not in ('wave', 'date', 'wave_start_date', 'industry_band')]
 
-    rewrite_csvs_w_empty_industry_bands_excluded(
-        input_csv_fn=os.path.join(out_path, 'workforcestatus.csv'),
-        metric_count=3,
-        specific_industry_bands_to_exclude=specific_industry_bands_to_exclude
-    )
 
-    rewrite_csvs_w_empty_industry_bands_excluded(
-        input_csv_fn=os.path.join(out_path, 'tradingstatus.csv'),
-        metric_count=3,
-        specific_industry_bands_to_exclude=specific_industry_bands_to_exclude
+def validate_metrics(df, metric_columns=None):
+    """
+    validation engine behind the filtering and validate_filtered_metrics(). Counts, per industry_band and per
+    metric, the records where the metric is null and, separately, where it is 0. Also counts per industry_band
+    the records (waves) it is present in and those that are empty i.e. where the metrics are all null or 0
+
+    the null and zero masks of all the metrics are computed a whole column at a time and then totalled per
+    industry_band with a single groupby, rather than looping over the records
+
+    :param df: df with an industry_band column and the metric columns, these can be numeric or the str read
+     from a csv, in which case '' is null
+    :param metric_columns: default is all columns other than wave, date, wave_start_date and industry_band
+    :return: dict of
+     rows: number of records
+     metrics: {metric: {'null': n, 'zero': n}}
+     bands: {industry_band: {'count_waves_present_in': n, 'count_waves_null_present_in': n, 'null': {metric: n},
+      'zero': {metric: n}}} in the order the industry_bands are first seen. count_waves_null_present_in is
+      the count of empty records, as used by industry_bands_to_exclude_from_counts()
+    """
+    import numpy as np
+    import pandas as pd
+
+    if metric_columns is None:
+        metric_columns = metric_columns_of(df.columns)
+
+    values = np.empty((len(df), len(metric_columns)), dtype='float64')
+    for i, metric in enumerate(metric_columns):
+        col = df[metric]
+        if not pd.api.types.is_numeric_dtype(col.dtype):
+            # '' --> NaN then a straight cast is much quicker than pd.to_numeric(), which is only
+            # needed should there be some other text in the column
+            try:
+                col = col.mask(col == '').astype('float64')
+            except ValueError:
+                col = pd.to_numeric(col, errors='coerce')
+        values[:, i] = col.to_numpy(dtype='float64', na_value=np.nan)
+
+    is_null = np.isnan(values)
+    is_zero = values == 0
+    # a record is empty when every one of its metrics is null or 0
+    is_empty = (is_null | is_zero).all(axis=1)
+
+    masks = pd.DataFrame(
+        np.hstack([is_null, is_zero, is_empty[:, None]]).astype('int64'),
+        columns=[('null', m) for m in metric_columns] + [('zero', m) for m in metric_columns] + [('empty', None)]
     )
 
-    rewrite_csvs_w_empty_industry_bands_excluded(
-        input_csv_fn=os.path.join(out_path, 'financialperformance.csv'),
-        metric_count=3,
-        specific_industry_bands_to_exclude=specific_industry_bands_to_exclude
-    )
+    # sort=False keeps the industry_band in the order they are first seen, as they are reported in that order
+    grouped = masks.groupby(df['industry_band'].to_numpy(), sort=False)
+    counts = grouped.sum()
+    sizes = grouped.size()
 
-    rewrite_csvs_w_empty_industry_bands_excluded(
-        input_csv_fn=os.path.join(out_path, 'cashflow.csv'),
-        metric_count=1,
-        specific_industry_bands_to_exclude=specific_industry_bands_to_exclude
-    )
+    report = {
+        'rows': len(df),
+        'metrics': {},
+        'bands': {}
+    }
+    for i, metric in enumerate(metric_columns):
+        report['metrics'][metric] = {'null': int(is_null[:, i].sum()), 'zero': int(is_zero[:, i].sum())}
 
+    for industry_band, band_counts in zip(counts.index, counts.to_numpy().tolist()):
+        report['bands'][industry_band] = {
+            'count_waves_present_in': int(sizes[industry_band]),
+            'count_waves_null_present_in': band_counts[-1],
+            'null': dict(zip(metric_columns, band_counts[:len(metric_columns)])),
+            'zero': dict(zip(metric_columns, band_counts[len(metric_columns):-1]))
+        }
 
-if __name__ == "__main__":
-    transform_data(
-        src_fn='C:\\Users\\james\\Desktop\\Work\\FGreen\\data\\basic data.xlsx',
-        out_path='C:\\Users\\james\\Desktop\\Work\\FGreen\\data_for_viz'
-    )
\ No newline at end of file
+    return report
+
+
+def combine_validation_reports(reports):
+    """
+    total a number of reports from validate_metrics() e.g. of the chunks of a csv too big to be read in one go
+
+    :param reports: list of reports
+    :return: report
+    """
+    combined = {'rows': 0, 'metrics': {}, 'bands': {}}
+    for report in reports:
+        combined['rows'] += report['rows']
+
+        for metric in report['metrics']:
+            counts = combined['metrics'].setdefault(metric, {'null': 0, 'zero': 0})
+            counts['null'] += report['metrics'][metric]['null']
+            counts['zero'] += report['metrics'][metric]['zero']
+
+        for industry_band in report['bands']:
+            band_report = report['bands'][industry_band]
+            if industry_band not in combined['bands']:
+                combined['bands'][industry_band] = {
+                    'count_waves_present_in': 0,
+                    'count_waves_null_present_in': 0,
+                    'null': dict.fromkeys(band_report['null'], 0),
+                    'zero': dict.fromkeys(band_report['zero'], 0)
+                }
+            counts = combined['bands'][industry_band]
+            counts['count_waves_present_in'] += band_report['count_waves_present_in']
+            counts['count_waves_null_present_in'] += band_report['count_waves_null_present_in']
+            for metric in band_report['null']:
+                counts['null'][metric] = counts['null'].get(metric, 0) + band_report['null'][metric]
+                counts['zero'][metric] = counts['zero'].get(metric, 0) + band_report['zero'][metric]
+
+    return combined
+
+
+def validate_rows(header, rows, metric_columns=None):
+    """
+    equivalent of validate_metrics() for the rows of a csv as read by the csv module, looping over the rows
+    rather than importing pandas. For the short lived filter and validate commands on csvs that are small
+    enough that importing pandas would take longer than the validating. Gives the same report
+
+    :param header: header of the csv, with the short column names
+    :param rows: iterable of rows, each a list of str, '' is null
+    :param metric_columns: default is all columns other than wave, date, wave_start_date and industry_band
+    :return: report, see validate_metrics()
+    """
+    if metric_columns is None:
+        metric_columns = metric_columns_of(header)
+
+    band_idx = header.index('industry_band')
+    metric_idxs = [header.index(metric) for metric in metric_columns]
+
+    report = {'rows': 0, 'metrics': {}, 'bands': {}}
+    metric_counts = [{'null': 0, 'zero': 0} for metric in metric_columns]
+
+    for r in rows:
+        report['rows'] += 1
+
+        industry_band = r[band_idx]
+        band_report = report['bands'].get(industry_band)
+        if band_report is None:
+            band_report = report['bands'][industry_band] = {
+                'count_waves_present_in': 0,
+                'count_waves_null_present_in': 0,
+                'null': dict.fromkeys(metric_columns, 0),
+                'zero': dict.fromkeys(metric_columns, 0)
+            }
+        band_report['count_waves_present_in'] += 1
+
+        null_or_zero_cell_count = 0
+        for metric, i, counts in zip(metric_columns, metric_idxs, metric_counts):
+            try:
+                value = float(r[i])
+            except ValueError:
+                # '' and any other text is null, as with pd.to_numeric(errors='coerce')
+                value = None
+
+            if value is None or value != value:
+                counts['null'] += 1
+                band_report['null'][metric] += 1
+                null_or_zero_cell_count += 1
+            elif value == 0:
+                counts['zero'] += 1
+                band_report['zero'][metric] += 1
+                null_or_zero_cell_count += 1
+
+        # a record is empty when every one of its metrics is null or 0
+        if null_or_zero_cell_count == len(metric_columns):
+            band_report['count_waves_null_present_in'] += 1
+
+    for metric, counts in zip(metric_columns, metric_counts):
+        report['metrics'][metric] = counts
+
+    return report
+
+
+def count_empty_waves_per_band_in_csv(input_csv_fn, metric_count, keep_rows=True, chunksize=100000, engine='pandas'):
+    """
+    first pass of rewrite_csvs_w_empty_industry_bands_excluded(), reads the csv and validates it with
+    validate_metrics(), which counts the waves each industry_band is present in and those where all of
+    its metric values are null/empty or 0
+
+    :param input_csv_fn:
+    :param metric_count: number of metric columns the csv should have
+    :param keep_rows: when True the csv is read in one go and the records returned, so the second pass doesn`t need
+     to read the csv again. Otherwise it is read chunksize records at a time
+    :param chunksize:
+    :param engine: 'pandas' to validate with validate_metrics(), or 'csv' to read the csv with the csv module and
+     validate with validate_rows(), which doesn`t import pandas
+    :return: tuple of (header, index of the industry_band column, report from validate_metrics(), records of the
+     csv or None). The records are a df of str with the pandas engine, a list of rows with the csv engine
+    :raises ValueError: if the csv doesn`t have metric_count metric columns
+    """
+    if engine == 'csv':
+        with open(input_csv_fn, 'r', newline='') as inpf:
+            my_reader = csv.reader(inpf)
+            header = next(my_reader, [])
+            check_metric_count(input_csv_fn, header, metric_count)
+
+            records = list(my_reader) if keep_rows else None
+            report = validate_rows(header, my_reader if records is None else records)
+    elif engine == 'pandas':
+        import pandas as pd
+
+        # read as str so that the values are written back out as they are
+        read_kwargs = {'dtype': str, 'keep_default_na': False}
+
+        if keep_rows:
+            records = pd.read_csv(input_csv_fn, **read_kwargs)
+            chunks = [records]
+        else:
+            records = None
+            chunks = pd.read_csv(input_csv_fn, chunksize=chunksize, **read_kwargs)
+
+        header = None
+        reports = []
+        for chunk in chunks:
+            if header is None:
+                header = list(chunk.columns)
+                check_metric_count(input_csv_fn, header, metric_count)
+            reports.append(validate_metrics(chunk))
+        report = combine_validation_reports(reports)
+    else:
+        raise ValueError('unknown engine {0!r}, expected pandas or csv'.format(engine))
+
+    band_idx = header.index('industry_band') if 'industry_band' in header else 3
+
+    return header, band_idx, report, records
+
+
+def check_metric_count(input_csv_fn, header, metric_count):
+    """
+    :param input_csv_fn:
+    :param header:
+    :param metric_count:
+    :return:
+    :raises ValueError: if the header doesn`t have metric_count metric columns
+    """
+    if len(metric_columns_of(header)) != metric_count:
+        raise ValueError('{0} has {1} metric columns, expected {2}'.format(
+            input_csv_fn,
+            len(metric_columns_of(header)),
+            metric_count
+        ))
+
+
+def write_csv_w_industry_bands_excluded(input_csv_fn, header, band_idx, industry_bands_to_exclude, records=None):
+    """
+    second pass of rewrite_csvs_w_empty_industry_bands_excluded(), writes the *_filtered.csv with the
+    records of industry_bands_to_exclude filtered off and the header renamed via header_lookup
+
+    :param input_csv_fn:
+    :param header: header of the input csv
+    :param band_idx: index of the industry_band column
+    :param industry_bands_to_exclude:
+    :param records: records of the input csv from count_empty_waves_per_band_in_csv() i.e. a df read as str or a
+     list of rows. When None the input csv is read again a row at a time
+    :return: path of the filtered csv
+    """
+    out_fn = input_csv_fn.replace('.csv', '_filtered.csv')
+
+    if records is not None and not isinstance(records, list):
+        write_filtered_csv(records[~records['industry_band'].isin(industry_bands_to_exclude)], out_fn)
+        return out_fn
+
+    industry_bands_to_exclude_lookup = set(industry_bands_to_exclude)
+    with open(out_fn, 'w', newline='') as outpf:
+        my_writer = csv.writer(outpf, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+
+        # change the column names in the header using our lut
+        new_header = []
+        for h in header:
+            if h in header_lookup:
+                new_header.append(header_lookup[h])
+        my_writer.writerow(new_header)
+
+        if records is not None:
+            my_writer.writerows(r for r in records if r[band_idx] not in industry_bands_to_exclude_lookup)
+        else:
+            with open(input_csv_fn, 'r') as inpf:
+                my_reader = csv.reader(inpf)
+                next(my_reader, [])
+                my_writer.writerows(r for r in my_reader if r[band_idx] not in industry_bands_to_exclude_lookup)
+
+    return out_fn
+
+
+def rewrite_csvs_w_empty_industry_bands_excluded(input_csv_fn, metric_count, specific_industry_bands_to_exclude=None,
+                                                  low_memory=False, engine='pandas'):
+    """
+    takes csv generated by convert_data() and re-writes it filtering off records associated with an
+    industry_band where all records per wave of that industry_band present in the csv have null/empty
+    values. Note values of 0 are allowed and don`t count as null/empty
+
+    done in two passes, count_empty_waves_per_band_in_csv() then write_csv_w_industry_bands_excluded()
+
+    :param input_csv_fn:
+    :param metric_count:
+    :param low_memory: when True the csv isn`t held in memory, it is read in chunks to validate and then read
+     a second time to write the filtered csv, so memory use doesn`t grow with the size of the csv
+    :param engine: see count_empty_waves_per_band_in_csv()
+    :return: report from validate_metrics() of the input csv, None if there is no input csv
+    """
+    if not os.path.exists(input_csv_fn):
+        return None
+
+    # unless low_memory, the csv is read once, the records are held on to so that once we know which
+    # industry_band are to be excluded the filtered csv can be written without reading the input again
+    with instrument_stage('filter_count_pass', sheet_for_csv_fn(input_csv_fn)) as record:
+        header, band_idx, report, records = count_empty_waves_per_band_in_csv(
+            input_csv_fn,
+            metric_count,
+            keep_rows=not low_memory,
+            engine=engine
+        )
+        record['rows'] = report['rows']
+
+    industry_bands_to_exclude = industry_bands_to_exclude_from_counts(
+        report['bands'],
+        specific_industry_bands_to_exclude
+    )
+
+    if len(industry_bands_to_exclude) > 0:
+        print('The following industry_bands will be excluded:')
+        for industry_band_to_exlude in industry_bands_to_exclude:
+            print('\t', industry_band_to_exlude)
+
+        print('Re-writing {0} as {1} with these excluded'.format(
+            input_csv_fn,
+            input_csv_fn.replace('.csv', '_filtered.csv')
+        ))
+        with instrument_stage('filter_write_pass', sheet_for_csv_fn(input_csv_fn)):
+            write_csv_w_industry_bands_excluded(input_csv_fn, header, band_idx, industry_bands_to_exclude, records)
+    print('\n')
+
+    return report
+
+
+def count_empty_waves_per_band(df):
+    """
+    for a df from convert_sheets_from_xlsx() read with vectorized=True count, per industry_band, the number of
+    waves it is present in and the number of these where the record is empty i.e. where the metric values are
+    all null or 0, see validate_metrics()
+
+    :param df: df with wave, date, wave_start_date, industry_band and metric columns
+    :return: dict in the form used by rewrite_csvs_w_empty_industry_bands_excluded() i.e.
+     {industry_band: {'count_waves_present_in': n, 'count_waves_null_present_in': m}} in the order
+     the industry_bands are first seen
+    """
+    waves_per_band = {}
+    bands_report = validate_metrics(df)['bands']
+    for industry_band in bands_report:
+        waves_per_band[industry_band] = {
+            'count_waves_present_in': bands_report[industry_band]['count_waves_present_in'],
+            'count_waves_null_present_in': bands_report[industry_band]['count_waves_null_present_in']
+        }
+
+    return waves_per_band
+
+
+def industry_bands_to_exclude_from_counts(waves_per_band, specific_industry_bands_to_exclude=None):
+    """
+    the industry_band which are empty for every wave they are present in, followed by any of
+    specific_industry_bands_to_exclude not already in the list
+
+    :param waves_per_band: dict from count_empty_waves_per_band()
+    :param specific_industry_bands_to_exclude: optional list of industry_band to exclude regardless
+    :return: list of industry_band
+    """
+    industry_bands_to_exclude = []
+    for industry_band in waves_per_band:
+        counts = waves_per_band[industry_band]
+        if counts['count_waves_null_present_in'] == counts['count_waves_present_in']:
+            industry_bands_to_exclude.append(industry_band)
+
+    if specific_industry_bands_to_exclude is not None:
+        for spc_band in specific_industry_bands_to_exclude:
+            if spc_band not in industry_bands_to_exclude:
+                industry_bands_to_exclude.append(spc_band)
+
+    return industry_bands_to_exclude
+
+
+def exclude_empty_industry_bands(df, specific_industry_bands_to_exclude=None):
+    """
+    in memory equivalent of rewrite_csvs_w_empty_industry_bands_excluded() for a df from convert_sheets_from_xlsx()
+    read with vectorized=True. Filters off records associated with an industry_band where all records per wave
+    of that industry_band have metric values that are all null or 0
+
+    :param df: df with wave, date, wave_start_date, industry_band and metric columns
+    :param specific_industry_bands_to_exclude: optional list of industry_band to exclude regardless
+    :return: tuple of (filtered df, list of industry_band that were excluded)
+    """
+    industry_bands_to_exclude = industry_bands_to_exclude_from_counts(
+        count_empty_waves_per_band(df),
+        specific_industry_bands_to_exclude
+    )
+
+    return df[~df['industry_band'].isin(industry_bands_to_exclude)], industry_bands_to_exclude
+
+
+def write_filtered_csv(df, out_fn, append=False):
+    """
+    write a df filtered by exclude_empty_industry_bands() out as csv in the same form as
+    rewrite_csvs_w_empty_industry_bands_excluded() does i.e. with the column names from header_lookup
+    and every value quoted. The csv module ends lines with \r\n so the same is done here
+
+    :param df:
+    :param out_fn:
+    :param append: when True the records are appended to an existing out_fn, without a header
+    :return:
+    """
+    columns_to_output = [c for c in df.columns if c in header_lookup]
+
+    header = [header_lookup[c] for c in columns_to_output]
+    if append:
+        header = False
+
+    with open(out_fn, 'a' if append else 'w', newline='') as outpf:
+        df.to_csv(
+            outpf,
+            columns=columns_to_output,
+            header=header,
+            index=False,
+            quoting=csv.QUOTE_ALL,
+            lineterminator='\r\n'
+        )
+
+
+def write_merged_csv(out_path, use_filtered=False):
+    """
+    take the 4 csv`s produced by convert_data and merges into a single csv containing
+    wave, industry_band and the columns from the 4 csv`s
+
+    the csvs are outer joined on (wave, industry_band) in one go, so where an industry_band/wave is missing from
+    one of the csvs, or one of the csvs is missing altogether, the metrics from it are left empty. Values are
+    passed through as the text they are in the csvs
+
+    NOTE: (start) date of waves in FinancialPerformance is inconsistent with other data
+    according to FG`s notes this is because the question refers to previous week
+    assumption is that the data can from different metrics can still be grouped by wave
+    even though in the case of FinancialPerformance this is 1 week difft
+
+    :param out_path: folder containing the csvs, the merged csv is written here too
+    :param use_filtered: when True merge the *_filtered.csv versions of the csvs, writing
+     merged_records_w_all_metrics_filtered.csv rather than merged_records_w_all_metrics.csv
+    :return: path of the merged csv
+    """
+    import numpy as np
+    import pandas as pd
+
+    metric_dfs = []
+    for df in read_wide_csvs(out_path, use_filtered).values():
+        metric_columns = [c for c in df.columns if c in merged_header and c not in ('wave', 'industry_band')]
+        metric_dfs.append(df.set_index(['wave', 'industry_band'])[metric_columns])
+
+    if len(metric_dfs) > 0:
+        merged = pd.concat(metric_dfs, axis=1, join='outer', sort=False).reset_index()
+    else:
+        merged = pd.DataFrame(columns=['wave', 'industry_band'])
+
+    # order by wave numerically, wave is still a str at this point
+    merged = merged.iloc[np.lexsort((merged['industry_band'], pd.to_numeric(merged['wave'])))]
+
+    merged_fn = 'merged_records_w_all_metrics.csv'
+    if use_filtered:
+        merged_fn = 'merged_records_w_all_metrics_filtered.csv'
+
+    # written to a temp file first so that a reader never sees a half written csv
+    merged_fn = os.path.join(out_path, merged_fn)
+    with open(merged_fn + '.tmp', 'w', newline='') as outpf:
+        merged.reindex(columns=merged_header).to_csv(outpf, index=False, quoting=csv.QUOTE_NONNUMERIC)
+    os.replace(merged_fn + '.tmp', merged_fn)
+
+    return merged_fn
+
+
+def read_wide_csvs(out_path, use_filtered=False):
+    """
+    read the csv of each sheet, as written by transform_data(), in the wide format they are written in i.e. a
+    column per metric, as object dtype frames of str with the short column names
+
+    :param out_path: folder containing the csvs
+    :param use_filtered: when True read the *_filtered.csv versions of the csvs
+    :return: dict mapping sheet to df, sheets whose csv is missing are left out
+    """
+    import pandas as pd
+
+    wide_dfs = {}
+    for sheet in bics_sheets:
+        pth_to_csv = csv_fn_for_sheet(out_path, sheet)
+        if use_filtered:
+            pth_to_csv = pth_to_csv.replace('.csv', '_filtered.csv')
+
+        if os.path.exists(pth_to_csv):
+            # the filtered csvs have the Tableau friendly column names so map these back
+            wide_dfs[sheet] = pd.read_csv(pth_to_csv, dtype=str, keep_default_na=False).rename(
+                columns=reverse_header_lookup
+            )
+
+    return wide_dfs
+
+
+def to_long_records(wide_dfs):
+    """
+    stack the wide dfs of the sheets into a single long/tidy df with a record per wave, industry_band and metric
+    i.e. the columns wave, wave_start_date, industry_band, metric and value
+
+    industry_band and metric are Categoricals, the categories of metric in the order of merged_header, wave
+    is the smallest int that fits, wave_start_date datetime64 and value float32 (NaN where null), so that
+    the records of every sheet fit in one compact df
+
+    :param wide_dfs: dict mapping sheet to df, see read_wide_csvs()
+    :return: df
+    """
+    import pandas as pd
+
+    id_columns = ['wave', 'wave_start_date', 'industry_band']
+
+    long_dfs = []
+    for sheet in wide_dfs:
+        wide_df = wide_dfs[sheet]
+        metric_columns = [c for c in metric_columns_of(wide_df.columns) if c in header_lookup]
+        long_dfs.append(wide_df.melt(
+            id_vars=id_columns,
+            value_vars=metric_columns,
+            var_name='metric',
+            value_name='value'
+        ))
+
+    if len(long_dfs) > 0:
+        long_df = pd.concat(long_dfs, ignore_index=True)
+    else:
+        long_df = pd.DataFrame(columns=id_columns + ['metric', 'value'])
+
+    metrics = [c for c in merged_header if c not in ('wave', 'industry_band')]
+
+    long_df['wave'] = pd.to_numeric(long_df['wave'], downcast='integer')
+    long_df['wave_start_date'] = pd.to_datetime(long_df['wave_start_date'], format='%d-%m-%Y')
+    long_df['industry_band'] = long_df['industry_band'].astype('category')
+    long_df['metric'] = pd.Categorical(long_df['metric'], categories=metrics)
+    long_df['value'] = long_df['value'].mask(long_df['value'] == '').astype('float32')
+
+    return long_df
+
+
+def write_long_csv(out_path, use_filtered=False):
+    """
+    write out the records of every sheet in the long format from to_long_records() as a single csv,
+    long_records_w_all_metrics[_filtered].csv. Values are written with 1 digit to right of the decimal
+    point, as in the other csvs, and left empty where null
+
+    the memory used by the long records is reported along the way, see long_records_memory_report()
+
+    :param out_path: folder containing the csvs, the long csv is written here too
+    :param use_filtered: when True use the *_filtered.csv versions of the csvs
+    :return: tuple of (path of the long csv, report from long_records_memory_report())
+    """
+    wide_dfs = read_wide_csvs(out_path, use_filtered)
+    long_df = to_long_records(wide_dfs)
+    report = long_records_memory_report(out_path, use_filtered, wide_dfs, long_df)
+
+    long_df['wave_start_date'] = long_df['wave_start_date'].dt.strftime('%d-%m-%Y')
+
+    long_fn = 'long_records_w_all_metrics.csv'
+    if use_filtered:
+        long_fn = 'long_records_w_all_metrics_filtered.csv'
+
+    # written to a temp file first so that a reader never sees a half written csv
+    long_fn = os.path.join(out_path, long_fn)
+    with open(long_fn + '.tmp', 'w', newline='') as outpf:
+        long_df.to_csv(outpf, index=False, float_format='%.1f')
+    os.replace(long_fn + '.tmp', long_fn)
+
+    return long_fn, report
+
+
+def long_records_memory_report(out_path, use_filtered=False, wide_dfs=None, long_df=None):
+    """
+    compare the memory used by the wide object dtype dfs of the csvs against the long df of the same records
+    from to_long_records(), and against the same long df were it left as object dtype
+
+    :param out_path: folder containing the csvs
+    :param use_filtered: when True use the *_filtered.csv versions of the csvs
+    :param wide_dfs: the dfs from read_wide_csvs(), when already read, otherwise they are read from out_path
+    :param long_df: the df from to_long_records() of wide_dfs, when already made
+    :return: dict of the bytes used by each and the number of records of the long df
+    """
+    if wide_dfs is None:
+        wide_dfs = read_wide_csvs(out_path, use_filtered)
+    if long_df is None:
+        long_df = to_long_records(wide_dfs)
+
+    report = {
+        'wide_object_bytes': int(sum(df.memory_usage(deep=True).sum() for df in wide_dfs.values())),
+        'long_object_bytes': int(long_df.astype(object).memory_usage(deep=True).sum()),
+        'long_bytes': int(long_df.memory_usage(deep=True).sum()),
+        'long_rows': len(long_df)
+    }
+
+    print('Memory used by the records of {0} sheets, {1} metric values:'.format(len(wide_dfs), report['long_rows']))
+    print('\t', 'wide csvs as object dtype:   {0:.2f}MB'.format(report['wide_object_bytes'] / 2 ** 20))
+    print('\t', 'long as object dtype:        {0:.2f}MB'.format(report['long_object_bytes'] / 2 ** 20))
+    print('\t', 'long categorical/float32:    {0:.2f}MB ({1:.1f}x less than wide)'.format(
+        report['long_bytes'] / 2 ** 20,
+        report['wide_object_bytes'] / max(report['long_bytes'], 1)
+    ))
+
+    return report
+
+
+def read_output_csv(csv_fn):
+    """
+    read one of the csvs written out by transform_data() back into a df, with the Tableau friendly column
+    names of the *_filtered.csv mapped back to the short names
+
+    :param csv_fn:
+    :return: df
+    """
+    import pandas as pd
+
+    return pd.read_csv(csv_fn, dtype={'date': str, 'industry_band': str}).rename(columns=reverse_header_lookup)
+
+
+def to_arrow_table(df):
+    """
+    convert a df of one of the outputs to a typed pyarrow Table. wave is int32, wave_start_date date32,
+    industry_band (and metric, of the long csv) dictionary encoded and the metrics (or value) float32. Each field keeps its Tableau friendly name
+    from header_lookup in its metadata as tableau_name, and the whole header_lookup is in the schema metadata
+
+    :param df: df with short column names e.g. from read_output_csv()
+    :return: pyarrow.Table
+    """
+    import pandas as pd
+
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError('pyarrow is needed to write parquet or feather output, pip install pyarrow')
+
+    fields = []
+    arrays = []
+    for c in df.columns:
+        if c == 'wave':
+            array = pa.array(pd.to_numeric(df[c]), type=pa.int32(), from_pandas=True)
+        elif c == 'date':
+            array = pa.array(df[c], type=pa.string(), from_pandas=True)
+        elif c == 'wave_start_date':
+            wave_start_dates = pd.to_datetime(df[c], format='%d-%m-%Y')
+            array = pa.array(wave_start_dates, type=pa.timestamp('ns'), from_pandas=True).cast(pa.date32())
+        elif c in ('industry_band', 'metric'):
+            array = pa.array(df[c], type=pa.string(), from_pandas=True).dictionary_encode()
+        else:
+            array = pa.array(pd.to_numeric(df[c], errors='coerce'), type=pa.float32(), from_pandas=True)
+
+        fields.append(pa.field(c, array.type, metadata={'tableau_name': header_lookup.get(c, c)}))
+        arrays.append(array)
+
+    schema = pa.schema(fields, metadata={'header_lookup': json.dumps(header_lookup)})
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_columnar_outputs(csv_fn, columnar_formats):
+    """
+    write a typed parquet and/or Arrow IPC (feather) copy of a csv alongside it e.g. for tradingstatus.csv
+    tradingstatus.parquet and tradingstatus.feather. The feather file is uncompressed so can be memory mapped
+
+    :param csv_fn: one of the csvs written out by transform_data()
+    :param columnar_formats: list containing 'parquet' and/or 'feather'
+    :return: list of the paths written
+    """
+    table = to_arrow_table(read_output_csv(csv_fn))
+
+    out_fns = []
+    for columnar_format in columnar_formats:
+        out_fn = csv_fn.replace('.csv', '.' + columnar_format)
+        if columnar_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, out_fn + '.tmp')
+        elif columnar_format == 'feather':
+            import pyarrow.feather as feather
+            feather.write_feather(table, out_fn + '.tmp', compression='uncompressed')
+        else:
+            raise ValueError('unknown columnar format {0!r}, expected parquet or feather'.format(columnar_format))
+        os.replace(out_fn + '.tmp', out_fn)
+        out_fns.append(out_fn)
+
+    return out_fns
+
+
+def index_fn_for_csv(csv_fn):
+    """
+    path of the sidecar index of a csv e.g. <out_path>/tradingstatus_filtered.csv --> <out_path>/tradingstatus_filtered.idx.json
+
+    :param csv_fn:
+    :return:
+    """
+    return csv_fn.replace('.csv', '.idx.json')
+
+
+def index_csv(csv_fn):
+    """
+    re-writes one of the *_filtered.csv sorted by industry_band then wave, and writes a sidecar index of it,
+    see index_fn_for_csv(), so that get_series() and get_cross_section() can seek straight to the records
+    they need rather than reading the whole csv
+
+    the index holds, per industry_band, the rows and bytes of its records, which being sorted are contiguous,
+    and per wave the byte ranges of its records, one per industry_band. Along with the size and mtime of the
+    csv so that an index that is out of date with its csv is never used
+
+    both files are written to temp files first and then replace the originals
+
+    :param csv_fn: path of csv, written as per write_filtered_csv() i.e. every value quoted
+    :return: path of the index
+    """
+    with open(csv_fn, 'r', newline='', encoding='utf-8') as inpf:
+        my_reader = csv.reader(inpf)
+        header = next(my_reader)
+        rows = list(my_reader)
+
+    wave_idx = header.index(header_lookup['wave'])
+    band_idx = header.index(header_lookup['industry_band'])
+    rows.sort(key=lambda r: (r[band_idx], int(r[wave_idx])))
+
+    index = {'csv': os.path.basename(csv_fn), 'columns': header, 'bands': {}, 'waves': {}}
+
+    # each row is written on its own to find out how many bytes it takes
+    line = io.StringIO()
+    my_writer = csv.writer(line, quoting=csv.QUOTE_ALL)
+
+    with open(csv_fn + '.tmp', 'wb') as outpf:
+        my_writer.writerow(header)
+        offset = outpf.write(line.getvalue().encode('utf-8'))
+        index['header_bytes'] = [0, offset]
+
+        for i, r in enumerate(rows):
+            line.seek(0)
+            line.truncate()
+            my_writer.writerow(r)
+            start = offset
+            offset += outpf.write(line.getvalue().encode('utf-8'))
+
+            # [first row, last row + 1, first byte, last byte + 1]
+            band_range = index['bands'].setdefault(r[band_idx], [i, i, start, start])
+            band_range[1] = i + 1
+            band_range[3] = offset
+
+            wave_ranges = index['waves'].setdefault(r[wave_idx], [])
+            if len(wave_ranges) > 0 and wave_ranges[-1][1] == start:
+                wave_ranges[-1][1] = offset
+            else:
+                wave_ranges.append([start, offset])
+
+    os.replace(csv_fn + '.tmp', csv_fn)
+
+    st = os.stat(csv_fn)
+    index['size'] = st.st_size
+    index['mtime_ns'] = st.st_mtime_ns
+
+    index_fn = index_fn_for_csv(csv_fn)
+    with open(index_fn + '.tmp', 'w') as outpf:
+        json.dump(index, outpf)
+    os.replace(index_fn + '.tmp', index_fn)
+
+    return index_fn
+
+
+def load_csv_index(csv_fn):
+    """
+    :param csv_fn: path of a csv indexed by index_csv()
+    :return: dict of the index
+    :raises ValueError: if there is no index, or the csv has changed since it was indexed
+    """
+    index_fn = index_fn_for_csv(csv_fn)
+    if not os.path.exists(index_fn):
+        raise ValueError('{0} has not been indexed, see index_csv()'.format(csv_fn))
+
+    with open(index_fn, 'r') as inpf:
+        index = json.load(inpf)
+
+    st = os.stat(csv_fn)
+    if st.st_size != index['size'] or st.st_mtime_ns != index['mtime_ns']:
+        raise ValueError('{0} has changed since it was indexed, see index_csv()'.format(csv_fn))
+
+    return index
+
+
+def read_csv_byte_ranges(csv_fn, index, byte_ranges):
+    """
+    read just the records in byte_ranges of a csv indexed by index_csv(), seeking to each in turn
+
+    :param csv_fn:
+    :param index: from load_csv_index()
+    :param byte_ranges: list of [first byte, last byte + 1]
+    :return: df with the columns of the csv, values as str, and short column names
+    """
+    import pandas as pd
+
+    chunks = []
+    with open(csv_fn, 'rb') as inpf:
+        for start, end in byte_ranges:
+            inpf.seek(start)
+            chunks.append(inpf.read(end - start))
+
+    df = pd.read_csv(
+        io.BytesIO(b''.join(chunks)),
+        header=None,
+        names=index['columns'],
+        dtype=str,
+        keep_default_na=False
+    )
+
+    return df.rename(columns=reverse_header_lookup)
+
+
+def get_series(csv_fn, metric, industry_band):
+    """
+    the values of a metric for each wave of an industry_band, read from a csv indexed by index_csv() without
+    reading the rest of the csv
+
+    e.g. get_series('tradingstatus_filtered.csv', 'ts_paused_trading', 'Education')
+
+    :param csv_fn: path of one of the *_filtered.csv
+    :param metric: name of the metric, either the short name or its tableau_name
+    :param industry_band:
+    :return: pd.Series of float64 indexed by wave, NaN where null. Empty if the industry_band isn`t in the csv
+    :raises ValueError: see load_csv_index(), or if metric isn`t in the csv
+    """
+    import pandas as pd
+
+    index = load_csv_index(csv_fn)
+
+    metric = reverse_header_lookup.get(metric, metric)
+    if header_lookup.get(metric) not in index['columns']:
+        raise ValueError('{0} is not a metric of {1}'.format(metric, csv_fn))
+
+    if industry_band not in index['bands']:
+        return pd.Series([], index=pd.Index([], dtype='int64', name='wave'), name=metric, dtype='float64')
+
+    band_range = index['bands'][industry_band]
+    df = read_csv_byte_ranges(csv_fn, index, [band_range[2:]])
+
+    values = df[metric].mask(df[metric] == '').astype('float64')
+    return pd.Series(values.to_numpy(), index=pd.Index(df['wave'].astype('int64'), name='wave'), name=metric)
+
+
+def get_cross_section(csv_fn, wave):
+    """
+    the records of every industry_band for a wave, read from a csv indexed by index_csv() without reading
+    the rest of the csv
+
+    :param csv_fn: path of one of the *_filtered.csv
+    :param wave:
+    :return: df with short column names, values as str as they are in the csv. Empty if the wave isn`t in the csv
+    :raises ValueError: see load_csv_index()
+    """
+    index = load_csv_index(csv_fn)
+
+    return read_csv_byte_ranges(csv_fn, index, index['waves'].get(str(wave), []))
+
+
+def validate_filtered_metrics(out_path, engine='pandas'):
+    """
+    for each of the 10 metrics obtain count of the number of records
+    where the metric value is null and, separately, where it is equal to zero
+
+    ts_current_and_started_trading 0 0
+    ts_paused_trading 12 75
+    ts_ceased_trading 0 200
+    cf_lt_3mths 0 0
+    fp_lower_turnover 15 0
+    fp_turnover_not_affected 18 0
+    fp_higher_turnover 0 26
+    ws_working_normal_place_of_work 0 0
+    ws_wfh 0 0
+    ws_on_furlough 0 0
+
+    i.e. for ws_wfh metric all records have a value other than 0
+    whereas for ts_paused_trading 12 records are null and 75 have a value which is 0
+
+    :param out_path:
+    :param engine: 'pandas' to validate with validate_metrics(), or 'csv' to validate with validate_rows(),
+     which doesn`t import pandas
+    :return: report from validate_metrics() of merged_records_w_all_metrics_filtered.csv
+    """
+    metrics = [metric for metric in merged_header if metric not in ('wave', 'industry_band')]
+    merged_fn = os.path.join(out_path, 'merged_records_w_all_metrics_filtered.csv')
+
+    if engine == 'csv':
+        with open(merged_fn, 'r', newline='') as inpf:
+            my_reader = csv.reader(inpf)
+            report = validate_rows(next(my_reader, []), my_reader, metrics)
+    elif engine == 'pandas':
+        import pandas as pd
+
+        report = validate_metrics(pd.read_csv(merged_fn, dtype=str, keep_default_na=False), metrics)
+    else:
+        raise ValueError('unknown engine {0!r}, expected pandas or csv'.format(engine))
+
+    print('Results of validating metrics.')
+    print('Counts of records per metric where metric value is null, then where it is equal to zero.')
+    print('0 0 = for the metric means all records have a value other than zero')
+    print('null > 0 for the metric means some records don`t have a value')
+    for metric in metrics:
+        print('\t', metric, report['metrics'][metric]['null'], report['metrics'][metric]['zero'])
+
+    return report
+
+
+def workbook_digest(xlsx_fn, use_mtime=False):
+    """
+    identifies the content of an xlsx for use in cache keys
+
+    :param xlsx_fn: path to .xlsx file
+    :param use_mtime: when True the modification time and size of the file are used, which is quicker than
+     hashing the content but will miss a change which keeps both the same
+    :return: str
+    """
+    if use_mtime:
+        st = os.stat(xlsx_fn)
+        return 'mtime:{0}:size:{1}'.format(st.st_mtime_ns, st.st_size)
+
+    h = hashlib.sha256()
+    with open(xlsx_fn, 'rb') as inpf:
+        for chunk in iter(functools.partial(inpf.read, 1024 * 1024), b''):
+            h.update(chunk)
+    return 'sha256:{0}'.format(h.hexdigest())
+
+
+def sheet_cache_key(digest, sheet, **config):
+    """
+    key of the cache entry for the output of a sheet. Made up from the workbook digest, the column and formatting
+    configuration of the sheet and anything else passed in config that affects what is written out
+
+    :param digest: from workbook_digest()
+    :param sheet:
+    :param config: e.g. limit_output_columns=True
+    :return: str
+    """
+    key_parts = {
+        'cache_version': cache_version,
+        'workbook': digest,
+        'sheet': sheet,
+        'sheet_schema': get_sheet_schema(sheet),
+        'config': config
+    }
+    return hashlib.sha256(json.dumps(key_parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def restore_from_cache(cache_dir, key, out_fns):
+    """
+    if there is a cache entry for key, restores the files in out_fns from it. Files in out_fns that are already
+    the same as those in the cache entry aren`t written. Files are copied along with their mtime, which the
+    sidecar index of a csv checks, see load_csv_index()
+
+    :param cache_dir:
+    :param key: from sheet_cache_key()
+    :param out_fns: paths of the files the cache entry holds
+    :return: True if the cache entry was found i.e. a cache hit
+    """
+    entry_path = os.path.join(cache_dir, key)
+    for out_fn in out_fns:
+        if not os.path.exists(os.path.join(entry_path, os.path.basename(out_fn))):
+            return False
+
+    for out_fn in out_fns:
+        cached_fn = os.path.join(entry_path, os.path.basename(out_fn))
+        if not (os.path.exists(out_fn) and filecmp.cmp(cached_fn, out_fn, shallow=False)):
+            shutil.copy2(cached_fn, out_fn)
+
+    # mtime of the entry is when it was last used, for evict_from_cache()
+    os.utime(entry_path)
+
+    return True
+
+
+def store_in_cache(cache_dir, key, out_fns):
+    """
+    copies the files in out_fns to the cache entry for key. The entry is built in a temp folder and renamed
+    into place so that an interrupted run never leaves a partial entry
+
+    :param cache_dir:
+    :param key: from sheet_cache_key()
+    :param out_fns:
+    :return:
+    """
+    entry_path = os.path.join(cache_dir, key)
+    tmp_entry_path = entry_path + '.tmp'
+
+    shutil.rmtree(tmp_entry_path, ignore_errors=True)
+    os.makedirs(tmp_entry_path)
+    for out_fn in out_fns:
+        if os.path.exists(out_fn):
+            shutil.copy2(out_fn, os.path.join(tmp_entry_path, os.path.basename(out_fn)))
+
+    shutil.rmtree(entry_path, ignore_errors=True)
+    os.rename(tmp_entry_path, entry_path)
+
+
+def evict_from_cache(cache_dir, max_cache_entries=default_max_cache_entries):
+    """
+    removes the least recently used entries from cache_dir so there are no more than max_cache_entries
+
+    :param cache_dir:
+    :param max_cache_entries:
+    :return: list of the keys of the entries removed
+    """
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, key)
+        if os.path.isdir(entry_path) and not key.endswith('.tmp'):
+            entries.append((os.path.getmtime(entry_path), key))
+
+    evicted = []
+    for mtime, key in sorted(entries, reverse=True)[max_cache_entries:]:
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        evicted.append(key)
+
+    return evicted
+
+
+def transform_sheet_in_memory(sheet, df, out_path, specific_industry_bands_to_exclude, write_raw_csvs=False):
+    """
+    filters a df from convert_sheets_from_xlsx() with exclude_empty_industry_bands() and writes out the
+    *_filtered.csv, and optionally the unfiltered csv, for the sheet
+
+    :param sheet:
+    :param df:
+    :param out_path:
+    :param specific_industry_bands_to_exclude:
+    :param write_raw_csvs:
+    :return:
+    """
+    out_fn = csv_fn_for_sheet(out_path, sheet)
+    if write_raw_csvs:
+        with instrument_stage('to_csv', sheet) as record, open(out_fn, 'w', newline='') as outpf:
+            df.to_csv(outpf, index=False)
+            record['rows'] = len(df)
+
+    with instrument_stage('filter', sheet) as record:
+        df_filtered, industry_bands_to_exclude = exclude_empty_industry_bands(
+            df,
+            specific_industry_bands_to_exclude=specific_industry_bands_to_exclude
+        )
+        record['rows'] = len(df)
+
+    print('The following industry_bands will be excluded:')
+    for industry_band_to_exlude in industry_bands_to_exclude:
+        print('\t', industry_band_to_exlude)
+
+    print('Writing {0} with these excluded'.format(out_fn.replace('.csv', '_filtered.csv')))
+    with instrument_stage('write_filtered', sheet) as record:
+        write_filtered_csv(df_filtered, out_fn.replace('.csv', '_filtered.csv'))
+        record['rows'] = len(df_filtered)
+    print('\n')
+
+
+def load_incremental_state(out_path):
+    """
+    load the state file kept in out_path by transform_data() when run with incremental=True
+
+    :param out_path:
+    :return: dict, empty if there is no state file yet
+    """
+    state_fn = os.path.join(out_path, incremental_state_fn)
+    if not os.path.exists(state_fn):
+        return {}
+
+    with open(state_fn, 'r') as inpf:
+        return json.load(inpf)
+
+
+def save_incremental_state(out_path, state):
+    """
+    save the state file, written to a temp file first so that a failed run never leaves a half written state
+
+    :param out_path:
+    :param state:
+    :return:
+    """
+    state_fn = os.path.join(out_path, incremental_state_fn)
+    with open(state_fn + '.tmp', 'w') as outpf:
+        json.dump(state, outpf, indent=2)
+    os.replace(state_fn + '.tmp', state_fn)
+
+
+def last_wave_in_csv(csv_fn):
+    """
+    :param csv_fn: a csv written by the conversion, raw or filtered, in both the wave is the first column
+    :return: the highest wave in the csv, None if it has no records
+    """
+    import pandas as pd
+
+    last_wave = pd.read_csv(csv_fn, usecols=[0]).iloc[:, 0].max()
+    return None if pd.isna(last_wave) else int(last_wave)
+
+
+def append_new_waves_to_csv(df, csv_fn):
+    """
+    append the records of df to a csv, leaving out those of waves the csv already has, so that appending
+    the same waves again e.g. when retrying a run that failed after appending them, doesn`t duplicate them
+
+    :param df: records of the new waves, in the columns of the csv
+    :param csv_fn: a csv written by the conversion
+    :return: number of records appended
+    """
+    last_wave = last_wave_in_csv(csv_fn)
+    if last_wave is not None:
+        df = df[df['wave'] > last_wave]
+
+    if len(df) > 0:
+        if csv_fn.endswith('_filtered.csv'):
+            write_filtered_csv(df, csv_fn, append=True)
+        else:
+            with open(csv_fn, 'a', newline='') as outpf:
+                df.to_csv(outpf, index=False, header=False)
+
+    return len(df)
+
+
+def transform_sheet_incremental(sheet, df, out_path, sheet_state, specific_industry_bands_to_exclude,
+                                write_raw_csvs=False):
+    """
+    incremental version of transform_sheet_in_memory(). Only the records of waves after the last wave
+    processed, as recorded in sheet_state, are appended to the existing csvs and the count of empty waves
+    per industry_band updated with these. Should this change which industry_band are excluded, or there
+    are no existing csvs to append to, the csvs for the sheet are rebuilt in full
+
+    assumes waves already processed are never revised in later releases of the xlsx. Waves the csvs already
+    have aren`t appended again, so a run that failed after appending to the csvs, but before the state was
+    saved, is safe to retry
+
+    :param sheet:
+    :param df: all records of the sheet from convert_sheets_from_xlsx() read with vectorized=True
+    :param out_path:
+    :param sheet_state: state of the sheet as returned from the last run, None if there wasn`t one
+    :param specific_industry_bands_to_exclude:
+    :param write_raw_csvs:
+    :return: new state of the sheet
+    """
+    out_fn = csv_fn_for_sheet(out_path, sheet)
+    out_fns = [out_fn.replace('.csv', '_filtered.csv')]
+    if write_raw_csvs:
+        out_fns.append(out_fn)
+
+    full_rebuild = sheet_state is None
+    for fn in out_fns:
+        if not os.path.exists(fn):
+            full_rebuild = True
+
+    if not full_rebuild:
+        new_df = df[df['wave'] > sheet_state['last_wave']]
+
+        # add the counts for the new waves onto those of the waves already processed
+        waves_per_band = sheet_state['waves_per_band']
+        new_waves_per_band = count_empty_waves_per_band(new_df)
+        for industry_band in new_waves_per_band:
+            if industry_band in waves_per_band:
+                for k in new_waves_per_band[industry_band]:
+                    waves_per_band[industry_band][k] += new_waves_per_band[industry_band][k]
+            else:
+                waves_per_band[industry_band] = new_waves_per_band[industry_band]
+
+        industry_bands_to_exclude = industry_bands_to_exclude_from_counts(
+            waves_per_band,
+            specific_industry_bands_to_exclude
+        )
+
+        if set(industry_bands_to_exclude) != set(sheet_state['industry_bands_to_exclude']):
+            print('The industry_bands to exclude from {0} have changed, rebuilding'.format(sheet))
+            full_rebuild = True
+
+    if full_rebuild:
+        transform_sheet_in_memory(sheet, df, out_path, specific_industry_bands_to_exclude, write_raw_csvs)
+        waves_per_band = count_empty_waves_per_band(df)
+        industry_bands_to_exclude = industry_bands_to_exclude_from_counts(
+            waves_per_band,
+            specific_industry_bands_to_exclude
+        )
+    else:
+        print('Appending {0} records from {1} new waves of {2} to {3}'.format(
+            len(new_df),
+            new_df['wave'].nunique(),
+            sheet,
+            ', '.join(out_fns)
+        ))
+        if len(new_df) > 0:
+            if write_raw_csvs:
+                append_new_waves_to_csv(new_df, out_fn)
+
+            new_df_filtered = new_df[~new_df['industry_band'].isin(industry_bands_to_exclude)]
+            append_new_waves_to_csv(new_df_filtered, out_fn.replace('.csv', '_filtered.csv'))
+        print('\n')
+
+    return {
+        'last_wave': int(df['wave'].max()),
+        'waves_per_band': waves_per_band,
+        'industry_bands_to_exclude': industry_bands_to_exclude
+    }
+
+
+def transform_sheet(src_fn, out_path, sheet, metric_count, specific_industry_bands_to_exclude, in_memory=False,
+                    write_raw_csvs=False, incremental=False, sheet_state=None, streaming=False, index_outputs=False,
+                    df=None):
+    """
+    the read --> derive wave_start_date --> write --> filter chain of transform_data() for a single sheet
+
+    :param src_fn: path to .xlsx file
+    :param out_path: folder the csvs are written to
+    :param sheet: name of the sheet
+    :param metric_count: number of metric columns in the csv of the sheet
+    :param specific_industry_bands_to_exclude:
+    :param in_memory: see transform_data()
+    :param write_raw_csvs: see transform_data()
+    :param incremental: see transform_data()
+    :param sheet_state: when incremental, the state of the sheet as returned from the last run
+    :param streaming: see transform_data()
+    :param index_outputs: see transform_data()
+    :param df: optional df of the sheet already read from src_fn by convert_sheets_from_xlsx(), with
+     limit_output_columns and, when in_memory or incremental, vectorized. Otherwise the sheet is read here
+    :return: when incremental, the new state of the sheet
+    """
+    if df is None and (incremental or in_memory):
+        df = dict(convert_sheets_from_xlsx(src_fn, limit_output_columns=True, vectorized=True, sheets=[sheet]))[sheet]
+
+    new_sheet_state = None
+    if incremental:
+        new_sheet_state = transform_sheet_incremental(
+            sheet, df, out_path, sheet_state, specific_industry_bands_to_exclude, write_raw_csvs
+        )
+    elif in_memory:
+        transform_sheet_in_memory(sheet, df, out_path, specific_industry_bands_to_exclude, write_raw_csvs)
+    else:
+        if df is None:
+            convert_data_from_xlsx_to_csv(
+                xlsx_fn=src_fn, out_path=out_path, limit_output_columns=True, sheets=[sheet], streaming=streaming
+            )
+        else:
+            write_sheet_csv(df, out_path, sheet)
+
+        # then we re-write the csv filtering off industry_band where there are waves containing completely null
+        # records, in addition those in specific_industry_bands_to_exclude are explicitly excluded too
+        rewrite_csvs_w_empty_industry_bands_excluded(
+            input_csv_fn=csv_fn_for_sheet(out_path, sheet),
+            metric_count=metric_count,
+            specific_industry_bands_to_exclude=specific_industry_bands_to_exclude,
+            low_memory=streaming
+        )
+
+    # when incremental and there were no new waves the state is unchanged and nothing was written
+    if index_outputs and not (incremental and new_sheet_state == sheet_state):
+        index_filtered_csvs(out_path, [sheet])
+
+    return new_sheet_state
+
+
+def index_filtered_csvs(out_path, sheets):
+    """
+    index_csv() the *_filtered.csv of each of the sheets that has one
+
+    :param out_path:
+    :param sheets:
+    :return:
+    """
+    for sheet in sheets:
+        filtered_fn = csv_fn_for_sheet(out_path, sheet).replace('.csv', '_filtered.csv')
+        if os.path.exists(filtered_fn):
+            with instrument_stage('index_csv', sheet):
+                index_csv(filtered_fn)
+
+
+def transform_sheets(src_fn, out_path, sheets, in_memory=False, write_raw_csvs=False, workers=None, incremental=False,
+                     cache_dir=None, force=False, use_mtime=False, max_cache_entries=default_max_cache_entries,
+                     streaming=False, index_outputs=False):
+    """
+    the per sheet part of transform_data() i.e. the csvs, *_filtered.csv and, if index_outputs, the sidecar
+    index of each sheet. See transform_data() for the params
+
+    :return: list of the sheets whose outputs were written, so not those restored from cache_dir or, when
+     incremental, those with no new waves
+    """
+    # number of metric columns in the csv for each sheet
+    metric_count_by_sheet = {}
+    for sheet in bics_sheets:
+        metric_count_by_sheet[sheet] = len(get_sheet_schema(sheet)['metrics'])
+
+    if cache_dir is not None:
+        if incremental:
+            raise ValueError('cache_dir can`t be used together with incremental')
+
+        if not os.path.exists(src_fn):
+            return []
+
+        os.makedirs(cache_dir, exist_ok=True)
+        digest = workbook_digest(src_fn, use_mtime)
+
+        keys_to_transform = {}
+        for sheet in sheets:
+            out_fn = csv_fn_for_sheet(out_path, sheet)
+            out_fns = [out_fn.replace('.csv', '_filtered.csv')]
+            if write_raw_csvs or not in_memory:
+                out_fns.append(out_fn)
+            # the sorted *_filtered.csv is what is cached so the index of it is too
+            if index_outputs:
+                out_fns.append(index_fn_for_csv(out_fns[0]))
+
+            key = sheet_cache_key(
+                digest,
+                sheet,
+                limit_output_columns=True,
+                metric_count=metric_count_by_sheet[sheet],
+                specific_industry_bands_to_exclude=specific_industry_bands_to_exclude,
+                out_fns=[os.path.basename(fn) for fn in out_fns]
+            )
+            if not force and restore_from_cache(cache_dir, key, out_fns):
+                print('Cache hit for {0}, not transforming'.format(sheet))
+            else:
+                keys_to_transform[sheet] = (key, out_fns)
+
+        if len(keys_to_transform) > 0:
+            transform_sheets(
+                src_fn, out_path, list(keys_to_transform), in_memory, write_raw_csvs, workers, streaming=streaming,
+                index_outputs=index_outputs
+            )
+            for sheet in keys_to_transform:
+                store_in_cache(cache_dir, *keys_to_transform[sheet])
+
+        evict_from_cache(cache_dir, max_cache_entries)
+
+        return list(keys_to_transform)
+
+    state = None
+    if incremental:
+        state = load_incremental_state(out_path)
+        # changing the explicit exclusions means a rebuild of every sheet
+        if state.get('specific_industry_bands_to_exclude') != specific_industry_bands_to_exclude:
+            state = {'specific_industry_bands_to_exclude': specific_industry_bands_to_exclude, 'sheets': {}}
+
+    # the state of a sheet is unchanged when there were no new waves, in which case nothing was written
+    transformed = []
+
+    if workers is not None and workers > 1:
+        if not os.path.exists(src_fn):
+            return transformed
+
+        kwargs_by_sheet = {}
+        for sheet in sheets:
+            kwargs_by_sheet[sheet] = {
+                'src_fn': src_fn,
+                'out_path': out_path,
+                'sheet': sheet,
+                'metric_count': metric_count_by_sheet[sheet],
+                'specific_industry_bands_to_exclude': specific_industry_bands_to_exclude,
+                'in_memory': in_memory,
+                'write_raw_csvs': write_raw_csvs,
+                'incremental': incremental,
+                'sheet_state': state['sheets'].get(sheet) if incremental else None,
+                'streaming': streaming,
+                'index_outputs': index_outputs
+            }
+
+        if incremental:
+            # the state of each sheet is saved as soon as it is known, so it isn`t lost should others fail
+            def on_result(sheet, sheet_state):
+                if sheet_state != state['sheets'].get(sheet):
+                    transformed.append(sheet)
+                state['sheets'][sheet] = sheet_state
+                save_incremental_state(out_path, state)
+        else:
+            on_result = None
+
+        run_per_sheet_in_pool(transform_sheet, kwargs_by_sheet, workers, on_result)
+
+        if not incremental:
+            transformed = list(sheets)
+        return transformed
+
+    if (in_memory or incremental) and not os.path.exists(src_fn):
+        return transformed
+
+    # the sheets are read here and handed to transform_sheet() so that the xlsx is only opened and parsed once.
+    # When streaming each sheet is streamed from the xlsx by itself, and when there is no xlsx there is nothing to
+    # read, but any csvs already in out_path are still filtered
+    if streaming or not os.path.exists(src_fn):
+        dfs = ((sheet, None) for sheet in sheets)
+    else:
+        dfs = convert_sheets_from_xlsx(
+            src_fn, limit_output_columns=True, vectorized=in_memory or incremental, sheets=sheets
+        )
+
+    for sheet, df in dfs:
+        sheet_state = transform_sheet(
+            src_fn, out_path, sheet, metric_count_by_sheet[sheet], specific_industry_bands_to_exclude, in_memory,
+            write_raw_csvs, incremental, state['sheets'].get(sheet) if incremental else None, streaming,
+            index_outputs, df
+        )
+
+        if incremental:
+            if sheet_state != state['sheets'].get(sheet):
+                transformed.append(sheet)
+            state['sheets'][sheet] = sheet_state
+            # saved after each sheet, so the sheets already appended to aren`t lost should a later one fail
+            save_incremental_state(out_path, state)
+        elif os.path.exists(src_fn):
+            transformed.append(sheet)
+
+    return transformed
+
+
+def derived_output_fns(out_path, sheets, write_merged=True, columnar_formats=None, long_format=False):
+    """
+    paths of the outputs write_derived_outputs() writes, given the csvs of the sheets that are in out_path
+
+    :param out_path:
+    :param sheets:
+    :param write_merged: see transform_data()
+    :param columnar_formats: see transform_data()
+    :param long_format: see transform_data()
+    :return: list of paths
+    """
+    out_fns = []
+    if write_merged:
+        out_fns.append(os.path.join(out_path, 'merged_records_w_all_metrics_filtered.csv'))
+    if long_format:
+        out_fns.append(os.path.join(out_path, 'long_records_w_all_metrics_filtered.csv'))
+
+    csv_fns = list(out_fns)
+    for sheet in sheets:
+        out_fn = csv_fn_for_sheet(out_path, sheet)
+        for csv_fn in (out_fn, out_fn.replace('.csv', '_filtered.csv')):
+            if os.path.exists(csv_fn):
+                csv_fns.append(csv_fn)
+
+    for columnar_format in (columnar_formats or []):
+        out_fns += [csv_fn.replace('.csv', '.' + columnar_format) for csv_fn in csv_fns]
+
+    return out_fns
+
+
+def write_derived_outputs(out_path, sheets, write_merged=True, columnar_formats=None, long_format=False):
+    """
+    the outputs of transform_data() that are derived from the csvs of the sheets i.e. the merged and long csvs
+    and the columnar copies of each of the csvs. See transform_data() for the params
+
+    :return:
+    """
+    out_fns = []
+    for sheet in sheets:
+        out_fns.append(csv_fn_for_sheet(out_path, sheet))
+        out_fns.append(csv_fn_for_sheet(out_path, sheet).replace('.csv', '_filtered.csv'))
+
+    if write_merged:
+        with instrument_stage('write_merged'):
+            out_fns.append(write_merged_csv(out_path, use_filtered=True))
+
+    if long_format:
+        with instrument_stage('write_long') as record:
+            long_fn, memory_report = write_long_csv(out_path, use_filtered=True)
+            out_fns.append(long_fn)
+            record['rows'] = memory_report['long_rows']
+            for k in ('wide_object_bytes', 'long_object_bytes', 'long_bytes'):
+                record[k] = memory_report[k]
+
+    if columnar_formats:
+        for out_fn in out_fns:
+            if os.path.exists(out_fn):
+                with instrument_stage('write_columnar', os.path.basename(out_fn)):
+                    write_columnar_outputs(out_fn, columnar_formats)
+
+
+def transform_data(src_fn, out_path, in_memory=False, write_raw_csvs=False, workers=None, incremental=False,
+                   cache_dir=None, force=False, use_mtime=False, max_cache_entries=default_max_cache_entries,
+                   sheets=None, write_merged=True, columnar_formats=None, streaming=False, long_format=False,
+                   index_outputs=False):
+    """
+    converts the sheets of the xlsx to csv then writes out *_filtered.csv versions of these with the
+    industry_band that are empty for every wave, or that we explicitly don`t want, excluded
+
+    :param src_fn: path to .xlsx file
+    :param out_path: folder the csvs are written to
+    :param in_memory: when True the dataframes read from the xlsx are filtered directly rather than being
+     written out to csv and then read back in again
+    :param write_raw_csvs: only applies when in_memory is True, in which case the unfiltered csvs are only
+     written out when this is True
+    :param workers: when > 1 each sheet is transformed, start to finish, concurrently in a pool of this many
+     processes. Output is printed per sheet in the usual sheet order and if any sheets fail a RuntimeError
+     listing them is raised once all have finished
+    :param incremental: when True, only the waves added since the last run are written, being appended to the
+     csvs from that run. Implies in_memory. The last wave processed and the count of empty waves per
+     industry_band for each sheet are kept in a state file in out_path, see transform_sheet_incremental()
+    :param cache_dir: optional folder to keep a cache of the csvs written for each sheet in. Sheets where neither
+     the xlsx nor the configuration has changed since they were cached are restored from the cache rather than
+     being transformed, so when nothing has changed nothing is parsed or written. Can`t be used with incremental
+    :param force: when True the cache isn`t used, every sheet is transformed and the cache updated
+    :param use_mtime: see workbook_digest()
+    :param max_cache_entries: max number of entries kept in cache_dir, see evict_from_cache()
+    :param sheets: optional list of the sheets to transform, default is all of bics_sheets
+    :param write_merged: when True the *_filtered.csv are then merged into merged_records_w_all_metrics_filtered.csv
+     by write_merged_csv(), which is what validate_filtered_metrics() checks
+    :param columnar_formats: optional list containing 'parquet' and/or 'feather'. Typed copies of each of the csvs
+     written in these formats are then written alongside them, see write_columnar_outputs(). Needs pyarrow
+    :param streaming: when True the sheets are streamed from the xlsx to csv by convert_sheet_streaming() and
+     the csvs filtered without being held in memory, so memory use stays flat however big the xlsx is. Can`t
+     be used with in_memory or incremental
+    :param long_format: when True the *_filtered.csv are also written out together in the long format of
+     to_long_records() as long_records_w_all_metrics_filtered.csv, see write_long_csv()
+    :param index_outputs: when True the *_filtered.csv are sorted by industry_band then wave and a sidecar
+     index written for each, for get_series() and get_cross_section(), see index_csv()
+    :return: list of the sheets that were transformed i.e. not those restored from cache_dir or, when
+     incremental, those with no new waves. When none were, the merged, long and columnar outputs are only
+     written if they don`t already exist
+    """
+    if streaming and (in_memory or incremental):
+        raise ValueError('streaming can`t be used together with in_memory or incremental')
+
+    if sheets is None:
+        sheets = bics_sheets
+
+    transformed = transform_sheets(
+        src_fn, out_path, sheets, in_memory, write_raw_csvs, workers, incremental, cache_dir, force, use_mtime,
+        max_cache_entries, streaming, index_outputs
+    )
+    if not os.path.exists(src_fn):
+        return transformed
+
+    # nothing has changed so neither have the outputs derived from the csvs, unless they haven`t been written yet
+    derived_fns = derived_output_fns(out_path, sheets, write_merged, columnar_formats, long_format)
+    if len(transformed) > 0 or not all(os.path.exists(fn) for fn in derived_fns):
+        write_derived_outputs(out_path, sheets, write_merged, columnar_formats, long_format)
+
+    return transformed
+
+
+def find_releases(src):
+    """
+    the workbooks of the releases to convert
+
+    :param src: folder containing the .xlsx of each release, or a glob of them e.g. data/bics_*.xlsx
+    :return: sorted list of paths, Excel`s ~$ lock files are left out
+    """
+    if os.path.isdir(src):
+        src = os.path.join(src, '*.xlsx')
+
+    return sorted(fn for fn in glob.glob(src) if not os.path.basename(fn).startswith('~$'))
+
+
+def release_dir_name(src_fn, digest):
+    """
+    name of the versioned folder a release is written to i.e. the name of the workbook followed by the start
+    of its hash, so a re-issued workbook of the same name is written to a folder of its own
+
+    e.g. basic data.xlsx --> basic_data_3f9a1c2e4b5d
+
+    :param src_fn:
+    :param digest: from workbook_digest()
+    :return: str
+    """
+    name = re.sub(r'[^0-9A-Za-z._-]+', '_', os.path.splitext(os.path.basename(src_fn))[0]).strip('_')
+    return '{0}_{1}'.format(name, digest.split(':')[-1][:12])
+
+
+def load_batch_manifest(out_root):
+    """
+    :param out_root:
+    :return: dict mapping release folder to its entry, see transform_releases(), empty if there is no manifest yet
+    """
+    manifest_fn = os.path.join(out_root, batch_manifest_fn)
+    if not os.path.exists(manifest_fn):
+        return {}
+
+    with open(manifest_fn, 'r') as inpf:
+        return json.load(inpf)
+
+
+def save_batch_manifest(out_root, manifest):
+    """
+    save the manifest, written to a temp file first so that a failed run never leaves a half written manifest
+
+    :param out_root:
+    :param manifest:
+    :return:
+    """
+    manifest_fn = os.path.join(out_root, batch_manifest_fn)
+    with open(manifest_fn + '.tmp', 'w') as outpf:
+        json.dump(manifest, outpf, indent=2, sort_keys=True)
+    os.replace(manifest_fn + '.tmp', manifest_fn)
+
+
+def transform_release(src_fn, out_root, release_dir, transform_kwargs):
+    """
+    transform_data() for one release of a batch, see transform_releases(). The release is written to a temp
+    folder which then replaces release_dir, so release_dir only ever holds a complete set of outputs
+
+    :param src_fn: path to .xlsx file
+    :param out_root:
+    :param release_dir: name of the folder in out_root the release is written to
+    :param transform_kwargs: kwargs for transform_data()
+    :return: list of the files written, relative to release_dir
+    """
+    out_path = os.path.join(out_root, release_dir)
+    tmp_path = out_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    try:
+        transform_data(src_fn, tmp_path, **transform_kwargs)
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.replace(tmp_path, out_path)
+
+    return sorted(os.listdir(out_path))
+
+
+def transform_releases(src, out_root, concurrency=2, force=False, **transform_kwargs):
+    """
+    transform_data() for every release of the BICS xlsx in a folder or glob, with up to concurrency of them
+    converted at once in a pool of processes. Each release is written to a versioned folder of its own in
+    out_root, see release_dir_name(), and recorded in out_root/manifest.json along with the hash of its xlsx.
+    Releases whose xlsx hash and transform_kwargs match those in the manifest are skipped
+
+    output is printed per release in the order of the releases and if any fail a RuntimeError listing them is
+    raised once all have finished. The manifest is saved with those that did succeed either way
+
+    :param src: see find_releases()
+    :param out_root: folder the release folders and manifest are written to
+    :param concurrency: max number of releases converted at once
+    :param force: when True every release is converted, regardless of the manifest
+    :param transform_kwargs: passed on to transform_data() e.g. in_memory=True
+    :return: dict mapping path of each xlsx to the release folder it is in
+    :raises RuntimeError: if any of the releases failed, listing the error for each of these
+    """
+    import concurrent.futures
+
+    os.makedirs(out_root, exist_ok=True)
+    manifest = load_batch_manifest(out_root)
+
+    # the kwargs are recorded in the manifest so need to be json, sort so the comparison doesn`t depend on order
+    config = json.loads(json.dumps(transform_kwargs, sort_keys=True))
+    config['cache_version'] = cache_version
+
+    release_dirs = {}
+    to_transform = {}
+    for src_fn in find_releases(src):
+        digest = workbook_digest(src_fn)
+        release_dir = release_dir_name(src_fn, digest)
+        release_dirs[src_fn] = release_dir
+
+        entry = manifest.get(release_dir)
+        if not force and entry is not None and entry['digest'] == digest and entry['config'] == config and \
+                os.path.isdir(os.path.join(out_root, release_dir)):
+            print('{0} already converted to {1}, skipping'.format(src_fn, release_dir))
+        else:
+            to_transform[src_fn] = digest
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        futures = {}
+        for src_fn in to_transform:
+            futures[src_fn] = executor.submit(
+                call_capturing_output,
+                transform_release,
+                {
+                    'src_fn': src_fn,
+                    'out_root': out_root,
+                    'release_dir': release_dirs[src_fn],
+                    'transform_kwargs': transform_kwargs
+                },
+                instrumentation['profile_dir'],
+                instrumentation['enabled'],
+                instrumentation['trace_memory']
+            )
+        concurrent.futures.wait(futures.values())
+
+    errors = []
+    for src_fn in futures:
+        try:
+            output, out_fns, records = futures[src_fn].result()
+        except Exception as e:
+            errors.append('{0}: {1!r}'.format(src_fn, e))
+            continue
+
+        print('Converted {0} to {1}'.format(src_fn, release_dirs[src_fn]))
+        print(output, end='')
+        instrumentation['records'].extend(records)
+
+        manifest[release_dirs[src_fn]] = {
+            'src_fn': os.path.abspath(src_fn),
+            'digest': to_transform[src_fn],
+            'config': config,
+            'converted_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'outputs': out_fns
+        }
+
+    save_batch_manifest(out_root, manifest)
+
+    if len(errors) > 0:
+        raise RuntimeError('{0} of {1} releases failed:\n\t{2}'.format(
+            len(errors),
+            len(futures),
+            '\n\t'.join(errors)
+        ))
+
+    return release_dirs
+
+
+def transform_data_atomically(src_fn, out_path, **transform_kwargs):
+    """
+    transform_data() into a temp folder in out_path, the files written then each replace those in out_path via
+    os.replace(), so anything reading out_path e.g. Tableau never sees a half written csv
+
+    :param src_fn: path to .xlsx file
+    :param out_path: folder the outputs are swapped into
+    :param transform_kwargs: passed on to transform_data(), other than incremental which needs the outputs
+     of the last run to be in the folder it writes to
+    :return: list of the files swapped into out_path
+    """
+    os.makedirs(out_path, exist_ok=True)
+    # in out_path so that it is on the same file system, which os.replace() needs
+    tmp_path = tempfile.mkdtemp(prefix='.tmp_', dir=out_path)
+    try:
+        transform_data(src_fn, tmp_path, **transform_kwargs)
+
+        out_fns = sorted(os.listdir(tmp_path))
+        for fn in out_fns:
+            os.replace(os.path.join(tmp_path, fn), os.path.join(out_path, fn))
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return out_fns
+
+
+async def watch_and_transform(src, out_path, poll_interval=1.0, debounce=2.0, convert_existing=False,
+                              stop_event=None, **transform_kwargs):
+    """
+    service that polls src for workbooks that are new or have changed and converts them into out_path with
+    transform_data_atomically()
+
+    a workbook is only converted once its size and mtime have stayed the same for debounce seconds, so one
+    still being copied in isn`t read part written. Where several are ready at once only the most recently
+    modified is converted, as each would replace the outputs of the others. The conversion is run in a
+    separate process so that the event loop is never held up parsing the xlsx, one at a time. A workbook
+    that fails to convert is reported and then left until it changes again
+
+    :param src: folder to watch, or glob of the workbooks within it, see find_releases()
+    :param out_path: folder the outputs are swapped into
+    :param poll_interval: seconds between each look at src
+    :param debounce: seconds a workbook has to be unchanged before it is converted
+    :param convert_existing: when True the workbooks already in src on start up are converted too, otherwise only
+     those that are added or changed after
+    :param stop_event: optional asyncio.Event, the service stops once this is set, otherwise it runs until cancelled
+    :param transform_kwargs: passed on to transform_data()
+    :return:
+    """
+    import asyncio
+    import concurrent.futures
+
+    if transform_kwargs.get('incremental'):
+        raise ValueError('incremental can`t be used when watching, as the outputs are written to a temp folder')
+
+    loop = asyncio.get_running_loop()
+
+    # the (size, mtime) of each workbook as last converted, or as first seen when not convert_existing
+    converted = {}
+    if not convert_existing:
+        for src_fn in find_releases(src):
+            st = os.stat(src_fn)
+            converted[src_fn] = (st.st_size, st.st_mtime_ns)
+
+    # the (size, mtime) of each workbook waiting to be converted and when it was last seen to change
+    pending = {}
+
+    print('Watching {0} for workbooks to convert into {1}'.format(src, out_path))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        while stop_event is None or not stop_event.is_set():
+            now = loop.time()
+            for src_fn in find_releases(src):
+                try:
+                    st = os.stat(src_fn)
+                except FileNotFoundError:
+                    continue
+
+                sig = (st.st_size, st.st_mtime_ns)
+                if converted.get(src_fn) == sig:
+                    pending.pop(src_fn, None)
+                elif src_fn not in pending or pending[src_fn][0] != sig:
+                    # new or still changing, (re)start the debounce
+                    pending[src_fn] = (sig, now)
+
+            ready = [src_fn for src_fn in pending if now - pending[src_fn][1] >= debounce]
+            if len(ready) > 0:
+                src_fn = max(ready, key=lambda fn: pending[fn][0][1])
+                for fn in ready:
+                    converted[fn] = pending.pop(fn)[0]
+                    if fn != src_fn:
+                        print('Skipping {0} in favour of {1}, which was modified more recently'.format(fn, src_fn))
+
+                print('Converting {0}'.format(src_fn))
+                t0 = loop.time()
+                try:
+                    output, out_fns, records = await loop.run_in_executor(
+                        executor,
+                        call_capturing_output,
+                        functools.partial(transform_data_atomically, src_fn, out_path),
+                        transform_kwargs,
+                        instrumentation['profile_dir'],
+                        instrumentation['enabled'],
+                        instrumentation['trace_memory']
+                    )
+                except Exception as e:
+                    print('Failed to convert {0}: {1!r}'.format(src_fn, e))
+                else:
+                    print(output, end='')
+                    instrumentation['records'].extend(records)
+                    print('Swapped {0} files from {1} into {2} in {3:.1f}s'.format(
+                        len(out_fns),
+                        src_fn,
+                        out_path,
+                        loop.time() - t0
+                    ))
+
+            if stop_event is None:
+                await asyncio.sleep(poll_interval)
+            else:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+
+if __name__ == "__main__":
+    import sys
+
+    default_src_fn = os.environ.get('BICS_SRC_FN', 'C:\\Users\\james\\Desktop\\Work\\FGreen\\data\\basic data.xlsx')
+    default_out_path = os.environ.get('BICS_OUT_PATH', 'C:\\Users\\james\\Desktop\\Work\\FGreen\\data_for_viz')
+
+    # options common to all the commands
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--metrics-json', default=None, help='write per stage timings and memory to this json')
+    common_parser.add_argument('--metrics-prom', default=None, help='write them to this Prometheus textfile (.prom) too')
+    common_parser.add_argument('--profile-dir', default=None, help='write a cProfile .prof of each stage to this folder')
+    common_parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help='trace allocations with tracemalloc to record the peak memory of each stage, slows the run down'
+    )
+    common_parser.add_argument('--log-level', default='WARNING', help='e.g. INFO to log the timings of each stage')
+
+    parser = argparse.ArgumentParser(description='convert the sheets of the ONS BICS xlsx to csvs for viz')
+    subparsers = parser.add_subparsers(dest='command')
+
+    transform_parser = subparsers.add_parser(
+        'transform',
+        parents=[common_parser],
+        help='convert, filter and merge i.e. the whole of transform_data(), the default command'
+    )
+    transform_parser.add_argument(
+        'src_fn',
+        nargs='?',
+        default=default_src_fn,
+        help='path to .xlsx file, with --batch or --watch a folder or glob of them. Defaults to $BICS_SRC_FN'
+    )
+    transform_parser.add_argument(
+        'out_path',
+        nargs='?',
+        default=default_out_path,
+        help='folder the csvs are written to, with --batch the folder the release folders are written to. '
+             'Defaults to $BICS_OUT_PATH'
+    )
+    transform_parser.add_argument('--batch', action='store_true', help='convert every release in src_fn')
+    transform_parser.add_argument('--watch', action='store_true', help='keep running, converting workbooks as they land')
+    transform_parser.add_argument('--poll-interval', type=float, default=1.0, help='with --watch seconds between polls')
+    transform_parser.add_argument('--debounce', type=float, default=2.0, help='with --watch seconds unchanged first')
+    transform_parser.add_argument('--concurrency', type=int, default=2, help='with --batch max releases at once')
+    transform_parser.add_argument('--in-memory', action='store_true', help='filter without the intermediate csvs')
+    transform_parser.add_argument('--write-raw-csvs', action='store_true', help='with --in-memory also write raw csvs')
+    transform_parser.add_argument('--workers', type=int, default=None, help='transform the sheets in a pool of processes')
+    transform_parser.add_argument('--incremental', action='store_true', help='only append waves added since last run')
+    transform_parser.add_argument('--streaming', action='store_true', help='stream the xlsx row by row to keep memory flat')
+    transform_parser.add_argument('--long-format', action='store_true', help='also write the filtered records long')
+    transform_parser.add_argument('--index', action='store_true', help='sort the filtered csvs by band and index them')
+    transform_parser.add_argument('--cache-dir', default=None, help='skip sheets that are unchanged since cached')
+    transform_parser.add_argument('--force', action='store_true', help='with --cache-dir transform every sheet')
+    transform_parser.add_argument('--use-mtime', action='store_true', help='with --cache-dir key on mtime+size')
+    transform_parser.add_argument('--max-cache-entries', type=int, default=default_max_cache_entries)
+    transform_parser.add_argument(
+        '--columnar-format',
+        action='append',
+        choices=['parquet', 'feather'],
+        help='also write typed copies of the csvs in this format, can be given more than once'
+    )
+
+    convert_parser = subparsers.add_parser(
+        'convert',
+        parents=[common_parser],
+        help='only dump the sheets of the xlsx to csv, see convert_data_from_xlsx_to_csv()'
+    )
+    convert_parser.add_argument('src_fn', nargs='?', default=default_src_fn, help='path to .xlsx file')
+    convert_parser.add_argument('out_path', nargs='?', default=default_out_path, help='folder the csvs are written to')
+    convert_parser.add_argument('--all-columns', action='store_true', help='output all columns, not just the metrics')
+    convert_parser.add_argument('--vectorized', action='store_true', help='format whole columns after reading')
+    convert_parser.add_argument('--streaming', action='store_true', help='stream the xlsx row by row to keep memory flat')
+    convert_parser.add_argument('--workers', type=int, default=None, help='convert the sheets in a pool of processes')
+    convert_parser.add_argument('--sheet', action='append', choices=bics_sheets, help='only this sheet, can be repeated')
+
+    filter_parser = subparsers.add_parser(
+        'filter',
+        parents=[common_parser],
+        help='write the *_filtered.csv from the csvs in out_path, see rewrite_csvs_w_empty_industry_bands_excluded()'
+    )
+    filter_parser.add_argument('out_path', nargs='?', default=default_out_path, help='folder containing the csvs')
+    filter_parser.add_argument('--sheet', action='append', choices=bics_sheets, help='only this sheet, can be repeated')
+    filter_parser.add_argument('--low-memory', action='store_true', help='read the csvs twice rather than hold them')
+    filter_parser.add_argument(
+        '--engine',
+        choices=['csv', 'pandas'],
+        default='csv',
+        help='csv doesn`t import pandas so starts quickest, pandas is quicker on very big csvs'
+    )
+
+    validate_parser = subparsers.add_parser(
+        'validate',
+        parents=[common_parser],
+        help='count null and zero values of merged_records_w_all_metrics_filtered.csv, see validate_filtered_metrics()'
+    )
+    validate_parser.add_argument('out_path', nargs='?', default=default_out_path, help='folder containing the csvs')
+    validate_parser.add_argument('--engine', choices=['csv', 'pandas'], default='csv', help='see filter --engine')
+    validate_parser.add_argument('--report-json', default=None, help='also write the full report to this json')
+
+    merge_parser = subparsers.add_parser(
+        'merge',
+        parents=[common_parser],
+        help='merge the csvs in out_path into merged_records_w_all_metrics[_filtered].csv, see write_merged_csv()'
+    )
+    merge_parser.add_argument('out_path', nargs='?', default=default_out_path, help='folder containing the csvs')
+    merge_parser.add_argument('--unfiltered', action='store_true', help='merge the unfiltered csvs')
+
+    # no command, as it was run before there were commands, is transform
+    argv = sys.argv[1:]
+    if len(argv) == 0 or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv = ['transform'] + argv
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.metrics_json or args.metrics_prom or args.profile_dir or args.trace_memory or \
+            args.log_level.upper() in ('INFO', 'DEBUG'):
+        enable_instrumentation(args.profile_dir, args.trace_memory)
+
+    if args.command == 'convert':
+        convert_data_from_xlsx_to_csv(
+            xlsx_fn=args.src_fn,
+            out_path=args.out_path,
+            limit_output_columns=not args.all_columns,
+            vectorized=args.vectorized,
+            sheets=args.sheet,
+            workers=args.workers,
+            streaming=args.streaming
+        )
+    elif args.command == 'filter':
+        for sheet in (args.sheet or bics_sheets):
+            rewrite_csvs_w_empty_industry_bands_excluded(
+                input_csv_fn=csv_fn_for_sheet(args.out_path, sheet),
+                metric_count=len(get_sheet_schema(sheet)['metrics']),
+                specific_industry_bands_to_exclude=specific_industry_bands_to_exclude,
+                low_memory=args.low_memory,
+                engine=args.engine
+            )
+    elif args.command == 'validate':
+        report = validate_filtered_metrics(args.out_path, engine=args.engine)
+        if args.report_json:
+            with open(args.report_json, 'w') as outpf:
+                json.dump(report, outpf, indent=2)
+    elif args.command == 'merge':
+        print('Written {0}'.format(write_merged_csv(args.out_path, use_filtered=not args.unfiltered)))
+    elif args.watch:
+        import asyncio
+
+        if args.incremental:
+            parser.error('--watch can`t be used with --incremental')
+
+        try:
+            asyncio.run(watch_and_transform(
+                src=args.src_fn,
+                out_path=args.out_path,
+                poll_interval=args.poll_interval,
+                debounce=args.debounce,
+                in_memory=args.in_memory,
+                write_raw_csvs=args.write_raw_csvs,
+                workers=args.workers,
+                cache_dir=args.cache_dir,
+                force=args.force,
+                use_mtime=args.use_mtime,
+                max_cache_entries=args.max_cache_entries,
+                columnar_formats=args.columnar_format,
+                streaming=args.streaming,
+                long_format=args.long_format,
+                index_outputs=args.index
+            ))
+        except KeyboardInterrupt:
+            pass
+    elif args.batch:
+        if args.incremental or args.cache_dir:
+            parser.error('--batch can`t be used with --incremental or --cache-dir')
+
+        transform_releases(
+            src=args.src_fn,
+            out_root=args.out_path,
+            concurrency=args.concurrency,
+            force=args.force,
+            in_memory=args.in_memory,
+            write_raw_csvs=args.write_raw_csvs,
+            workers=args.workers,
+            columnar_formats=args.columnar_format,
+            streaming=args.streaming,
+            long_format=args.long_format,
+            index_outputs=args.index
+        )
+    else:
+        transform_data(
+            src_fn=args.src_fn,
+            out_path=args.out_path,
+            in_memory=args.in_memory,
+            write_raw_csvs=args.write_raw_csvs,
+            workers=args.workers,
+            incremental=args.incremental,
+            cache_dir=args.cache_dir,
+            force=args.force,
+            use_mtime=args.use_mtime,
+            max_cache_entries=args.max_cache_entries,
+            columnar_formats=args.columnar_format,
+            streaming=args.streaming,
+            long_format=args.long_format,
+            index_outputs=args.index
+        )
+
+    if args.metrics_json:
+        write_metrics_json(args.metrics_json)
+    if args.metrics_prom:
+        write_metrics_prometheus(args.metrics_prom)